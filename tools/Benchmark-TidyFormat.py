@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+## A script to measure the throughput of Clang-TidyFormat.py operations,
+#  outputs the time each variant takes on the same inputs.
+
+import Template
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+## Load Clang-TidyFormat.py as a module
+#  @return module object
+def loadTidyFormat():
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "Clang-TidyFormat.py")
+  spec = importlib.util.spec_from_file_location("TidyFormat", path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+## Time a function, suppressing its output
+#  @param func to call
+#  @param repeat number of times to call func, the fastest is returned
+#  @return seconds the fastest call took
+def timeIt(func, repeat):
+  best = None
+  for _ in range(repeat):
+    with contextlib.redirect_stdout(io.StringIO()):
+      start = time.perf_counter()
+      func()
+      elapsed = time.perf_counter() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+## Print the result of a benchmark
+#  @param name of variant measured
+#  @param elapsed seconds the variant took
+#  @param count number of items processed
+#  @param unit of items processed
+def printResult(name, elapsed, count, unit):
+  print("{:<32} {:>9.3f}s {:>12.1f} {}/s".format(name, elapsed,
+                                                 count / elapsed, unit))
+
+## Compare per-file and batched clang-format throughput
+#  @param tidyFormat Clang-TidyFormat module
+#  @param args object of arguments
+def benchmarkFormat(tidyFormat, args):
+  files = tidyFormat.getFileList(args.git,
+                                 re.compile(args.regex, re.IGNORECASE))
+  print("Checking formatting of {} files with -j {}".format(len(files), args.j))
+  batchSizes = [1, 0] + args.batch
+  async def run(batchSize):
+    scheduler = tidyFormat.Scheduler(args.j, False)
+    return await tidyFormat.formatFiles(scheduler, args.clang_format, False,
+                                        True, files, None, batchSize)
+  for batchSize in batchSizes:
+    elapsed = timeIt(lambda: tidyFormat.runAsync(run(batchSize)), args.repeat)
+    if batchSize == 0:
+      name = "batched, automatic ({})".format(
+          tidyFormat.getFormatBatchSize(len(files), args.j))
+    elif batchSize == 1:
+      name = "per-file"
+    else:
+      name = "batched, {}".format(batchSize)
+    printResult(name, elapsed, len(files), "files")
+
+## Generate a synthetic listing of repository paths
+#  @param count number of paths
+#  @return list of relative paths, a mix of sources, tests and other files
+def getSyntheticPaths(count):
+  extensions = [".cpp", ".hpp", ".h", ".c", ".txt", ".md", ".py", ".png"]
+  return ["project-{}/module-{}/{}file{}{}".format(
+      i % 97, i % 1013, "test_" if i % 11 == 0 else "", i,
+      extensions[i % len(extensions)]) for i in range(count)]
+
+## Filter paths the way file discovery did before it was set based
+#  @param paths list of relative paths
+#  @param pattern compiled regex to match absolute file name to
+#  @return list of absolute file paths
+def filterPathsLegacy(paths, pattern):
+  files = []
+  for filename in paths:
+    filename = Template.makeAbsolute(filename, os.getcwd())
+    if re.match(pattern, filename) and filename not in files:
+      files.append(filename)
+  return files
+
+## Compare list based and set based file discovery on a synthetic listing
+#  @param tidyFormat Clang-TidyFormat module
+#  @param args object of arguments
+def benchmarkDiscovery(tidyFormat, args):
+  paths = getSyntheticPaths(args.paths)
+  pattern = re.compile(args.regex, re.IGNORECASE)
+  extensions = tidyFormat.getExtensions(args.regex)
+  print("Filtering {} synthetic paths".format(len(paths)))
+
+  # Listing is split by newlines before and NUL now, include each in its time
+  legacyPaths = paths[:args.legacy_paths]
+  legacyListing = "\n".join(legacyPaths)
+  elapsed = timeIt(lambda: filterPathsLegacy(legacyListing.split("\n"), pattern),
+                   args.repeat)
+  printResult("list, {} paths".format(len(legacyPaths)), elapsed,
+              len(legacyPaths), "paths")
+
+  listing = "\0".join(paths).encode()
+  elapsed = timeIt(lambda: tidyFormat.filterPaths(
+      (os.fsdecode(path) for path in listing.split(b"\0")), pattern),
+      args.repeat)
+  printResult("set", elapsed, len(paths), "paths")
+  elapsed = timeIt(lambda: tidyFormat.filterPaths(
+      (os.fsdecode(path) for path in listing.split(b"\0")), pattern,
+      extensions), args.repeat)
+  printResult("set, extension prefilter", elapsed, len(paths), "paths")
+
+## Main function
+def main():
+  parser = argparse.ArgumentParser(description="Measure the throughput of "
+                                   "Clang-TidyFormat.py operations")
+  parser.add_argument("benchmark", choices=["format", "discovery"],
+                      help="operation to measure")
+  parser.add_argument("--clang-format", metavar="PATH", default="clang-format",
+                      help="path to clang-format binary")
+  parser.add_argument("--git", metavar="PATH", default="git",
+                      help="path to git binary")
+  parser.add_argument("--regex", metavar="PATTERN", default=r"^((?!test).)*\.(cpp|cc|c\+\+|cxx|c|h|hpp)$",
+                      help="custom pattern selecting file paths to check "
+                      "(case insensitive)")
+  parser.add_argument("-j", type=int, default=multiprocessing.cpu_count(),
+                      help="number of instances to be run in parallel.")
+  parser.add_argument("--batch", metavar="N", type=int, action="append",
+                      default=[], help="additional batch size to measure")
+  parser.add_argument("--paths", metavar="N", type=int, default=200000,
+                      help="number of synthetic paths for discovery")
+  parser.add_argument("--legacy-paths", metavar="N", type=int, default=20000,
+                      help="number of synthetic paths for the list based "
+                      "discovery, which is quadratic")
+  parser.add_argument("--repeat", metavar="N", type=int, default=3,
+                      help="number of runs of each variant, fastest is reported")
+
+  argv = sys.argv[1:]
+  args = parser.parse_args(argv)
+
+  tidyFormat = loadTidyFormat()
+  if args.benchmark == "format":
+    Template.checkInstallations(
+        git=args.git,
+        clangFormat=args.clang_format,
+        quiet=True)
+    benchmarkFormat(tidyFormat, args)
+  elif args.benchmark == "discovery":
+    benchmarkDiscovery(tidyFormat, args)
+
+
+if __name__ == "__main__":
+  main()
@@ -4,51 +4,120 @@
 #  Optionally checks only changed files. Optionally automatically fixes the
 #  errors.
 
+import CompileDatabase
+import Diagnostics
+import Replacements
 import Template
 
 import argparse
+import asyncio
+import codecs
+import contextlib
+import functools
+import hashlib
 import json
 import multiprocessing
 import os
-import queue
 import re
+import shlex
 import shutil
+import socket
+import socketserver
 import subprocess
 import sys
 import tempfile
 import threading
-import traceback
+import time
+
+## Get the file extensions a pattern requires, used to skip paths before
+#  running the regex
+#  @param pattern regex string, i.e. r"^.*\.(cpp|h)$"
+#  @return tuple of lowercase extensions including the ".", None if the pattern
+#    does not always end with an alternation of extensions
+def getExtensions(pattern):
+  # A top level alternation could match paths without the extension
+  depth = 0
+  escaped = False
+  for c in pattern:
+    if escaped:
+      escaped = False
+    elif c == "\\":
+      escaped = True
+    elif c in "([":
+      depth += 1
+    elif c in ")]":
+      depth -= 1
+    elif c == "|" and depth == 0:
+      return None
+  match = re.search(r"\\\.\(((?:\w|\\\W)+(?:\|(?:\w|\\\W)+)*)\)\$$", pattern)
+  if not match:
+    return None
+  return tuple("." + re.sub(r"\\(.)", r"\1", extension).lower()
+               for extension in match[1].split("|"))
+
+## Iterate over the paths a git command outputs, separated by NUL
+#  @param cmd git command to run, must output NUL separated paths (-z)
+#  @return generator of path strings
+def iterGitPaths(cmd):
+  with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+    remainder = b""
+    for chunk in iter(functools.partial(proc.stdout.read, 1 << 16), b""):
+      paths = (remainder + chunk).split(b"\0")
+      remainder = paths.pop()
+      for path in paths:
+        if path:
+          yield os.fsdecode(path)
+    if remainder:
+      yield os.fsdecode(remainder)
+  if proc.returncode != 0:
+    raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+## Filter paths relative to the current directory by extension and regex pattern
+#  @param paths iterable of relative paths
+#  @param pattern compiled regex to match absolute file name to
+#  @param extensions tuple of lowercase extensions a file must have, None to
+#    only use pattern
+#  @param files dictionary of absolute paths already selected, new paths are
+#    added to it
+#  @param mustExist true will skip paths that do not exist, i.e. deleted files
+#  @return files
+def filterPaths(paths, pattern, extensions=None, files=None, mustExist=False):
+  if files is None:
+    files = {}
+  prefix = os.path.join(os.getcwd(), "")
+  for path in paths:
+    if extensions and not path.lower().endswith(extensions):
+      continue
+    filename = os.path.normpath(prefix + path)
+    if filename in files or not pattern.match(filename):
+      continue
+    if mustExist and not os.path.exists(filename):
+      continue
+    files[filename] = None
+  return files
 
 ## Get a list of all files (caring for gitignore) that match the regex pattern
 #  @param git executable
 #  @param pattern regex to match file name to
+#  @param extensions tuple of lowercase extensions a file must have, None to
+#    only use pattern
 #  @return list of absolute file paths to process
-def getFileList(git, pattern):
-  files = []
-  cmd = [git, "ls-files", "--exclude-standard",
+def getFileList(git, pattern, extensions=None):
+  cmd = [git, "ls-files", "-z", "--exclude-standard",
          "--modified", "--others", "--cached"]
-  result = subprocess.check_output(cmd, universal_newlines=True).strip()
-  for filename in result.split("\n"):
-    filename = Template.makeAbsolute(filename, os.getcwd())
-    if re.match(pattern, filename) and filename not in files:
-      files.append(filename)
-  return files
+  return list(filterPaths(iterGitPaths(cmd), pattern, extensions))
 
 ## Get a list of all modified/added files (caring for gitignore) that match the
 #  regex pattern
 #  @param git executable
 #  @param pattern regex to match file name to
 #  @param stagedOnly true will only check files added to the stage (git add FILE)
+#  @param extensions tuple of lowercase extensions a file must have, None to
+#    only use pattern
 #  @return list of absolute file paths to process
-def getChangedFileList(git, pattern, stagedOnly):
-  files = []
-  cmd = [git, "diff-index", "--cached", "--name-only", "HEAD"]
-  result = subprocess.check_output(cmd, universal_newlines=True).strip()
-  for filename in result.split("\n"):
-    filename = Template.makeAbsolute(filename, os.getcwd())
-    if re.match(pattern, filename) and filename not in files and os.path.exists(
-      filename):
-      files.append(filename)
+def getChangedFileList(git, pattern, stagedOnly, extensions=None):
+  cmd = [git, "diff-index", "-z", "--cached", "--name-only", "HEAD"]
+  files = filterPaths(iterGitPaths(cmd), pattern, extensions, mustExist=True)
 
   if(stagedOnly):
     # # Check if each file in the repository is the version that is being
@@ -68,16 +137,291 @@ def getChangedFileList(git, pattern, stagedOnly):
     #     print("File has changes not staged, cannot run on", file)
     # if unstagedEdits:
     #   sys.exit(1)
-    return files
-
-  cmd = [git, "ls-files", "--exclude-standard", "--modified", "--others"]
-  result = subprocess.check_output(cmd, universal_newlines=True).strip()
-  for filename in result.split("\n"):
-    filename = Template.makeAbsolute(filename, os.getcwd())
-    if re.match(pattern, filename) and filename not in files and os.path.exists(
-      filename):
-      files.append(filename)
-  return files
+    return list(files)
+
+  cmd = [git, "ls-files", "-z", "--exclude-standard", "--modified", "--others"]
+  return list(filterPaths(iterGitPaths(cmd), pattern, extensions, files,
+                          mustExist=True))
+
+## Copies of the content of tracked files in the index that differs from their
+#  working tree, checked in place of the working tree so it is never touched,
+#  file: path of its copy, see getStagedContent
+stagedContent = {}
+
+## Get the staged content of tracked files whose working tree has changes not
+#  staged, read from the index through git cat-file. Every such file matching
+#  the pattern is included, not only the staged ones, as the files checked may
+#  include any of them.
+#  @param git executable
+#  @param pattern regex to match file name to
+#  @param extensions tuple of lowercase extensions a file must have, None to
+#    only use pattern
+#  @param directory to copy the staged content to, each blob is streamed to
+#    its copy without holding it in memory
+#  @return dictionary of file: path of the copy of its staged content, files
+#    whose working tree matches the stage are not included
+def getStagedContent(git, pattern, extensions, directory):
+  prefix = os.path.join(os.getcwd(), "")
+  cmd = [git, "diff", "-z", "--name-only", "--no-renames",
+         "--ignore-submodules"]
+  paths = list(iterGitPaths(cmd))
+  # ":<path>" names the staged blob of a path relative to the repository
+  names = {os.path.normpath(prefix + path): ":" + path for path in paths}
+  names = {name: names[name]
+           for name in filterPaths(paths, pattern, extensions)}
+
+  objects = Template.getGitObjects(git)
+  contents = {}
+  for i, (name, objectName) in enumerate(sorted(names.items())):
+    # The extension still selects the language
+    path = os.path.join(directory, "staged{}{}".format(
+        i, os.path.splitext(name)[1]))
+    with open(path, "wb") as file:
+      found = objects.copy(objectName, file)
+    if found is None:
+      print("Could not read staged", name, file=sys.stderr)
+      sys.exit(1)
+    contents[name] = path
+  return contents
+
+## Get the line ranges changed in each file from git diff
+#  @param git executable
+#  @param stagedOnly true will only consider changes added to the stage
+#  @return dictionary of absolute file path: list of [first, last] line ranges,
+#    files without a diff (i.e. untracked) are not included
+def getChangedLines(git, stagedOnly):
+  # Paths of the diff are relative to the top of the repository
+  root = subprocess.check_output([git, "rev-parse", "--show-toplevel"],
+                                 universal_newlines=True).strip()
+  # Set the prefixes, diff.noprefix and diff.mnemonicPrefix change them
+  cmd = [git, "-c", "core.quotepath=off", "diff", "-U0", "--no-color",
+         "--no-ext-diff", "--src-prefix=a/", "--dst-prefix=b/"]
+  if stagedOnly:
+    cmd.append("--cached")
+  cmd.append("HEAD")
+  result = subprocess.check_output(cmd, universal_newlines=True)
+
+  lines = {}
+  ranges = None
+  for line in result.split("\n"):
+    if line.startswith("+++ "):
+      # Names with spaces are followed by a tab
+      path = line[4:].rstrip("\t")
+      if path == "/dev/null":
+        ranges = None
+        continue
+      if path.startswith("\""):
+        # Names with control characters, quotes or backslashes are C-quoted
+        path = codecs.escape_decode(path[1:-1].encode())[0].decode(
+            errors="replace")
+      ranges = lines.setdefault(os.path.normpath(os.path.join(root, path[2:])),
+                                [])
+      continue
+    match = re.match(r"@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@", line)
+    if match and ranges is not None:
+      first = int(match[1])
+      count = 1 if match[2] is None else int(match[2])
+      if count == 0:
+        # Removed lines, check the line the removal joined
+        ranges.append([max(first, 1), max(first, 1)])
+      else:
+        ranges.append([first, first + count - 1])
+  return lines
+
+## Get the version string reported by a tool, probed once per run and cached
+#  between runs
+#  @param exe executable
+#  @return output of exe --version
+@functools.lru_cache(maxsize=None)
+def getToolVersion(exe):
+  return Template.probe([exe, "--version"]).strip()
+
+## Get the content of the configuration file a tool uses for a directory, the
+#  first one found whilst checking parent folders until root
+#  @param configFile name of the configuration file, i.e. ".clang-format"
+#  @param directory to start searching from
+#  @return bytes of the configuration file, empty if none is found
+@functools.lru_cache(maxsize=None)
+def getConfigContent(configFile, directory):
+  path = os.path.join(directory, configFile)
+  if os.path.isfile(path):
+    with open(path, "rb") as file:
+      return file.read()
+  parent = os.path.dirname(directory)
+  if parent == directory:
+    return b""
+  return getConfigContent(configFile, parent)
+
+## Get the digest of a file's content, computed once per run
+#  @param name of file to digest
+#  @return hex digest string
+@functools.lru_cache(maxsize=None)
+def getFileDigest(name):
+  digest = hashlib.sha256()
+  with open(stagedContent.get(name, name), "rb") as file:
+    for chunk in iter(functools.partial(file.read, 1 << 16), b""):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+## Compute the key of a file's cached result, changes whenever the file, the
+#  tool, or the tool's configuration changes
+#  @param name of file to key
+#  @param toolVersion string of the tool checking the file
+#  @param configFile name of the tool's configuration file, i.e. ".clang-format"
+#  @param extra string to add to the key, i.e. the file's compile command
+#  @return hex digest string
+def getResultKey(name, toolVersion, configFile, extra=""):
+  digest = hashlib.sha256(getFileDigest(name).encode())
+  for item in [toolVersion.encode(), getConfigContent(
+      configFile, os.path.dirname(name)), extra.encode()]:
+    digest.update(b"\0")
+    digest.update(item)
+  return digest.hexdigest()
+
+## Get the include directories of a compile command
+#  @param entry of the compilation database
+#  @param normalize false will join relative directories to the command's
+#    directory as the compiler does, without normalizing them
+#  @return list of absolute include directories in search order
+def getIncludeDirectories(entry, normalize=True):
+  if "arguments" in entry:
+    arguments = entry["arguments"]
+  else:
+    arguments = shlex.split(entry["command"], posix=(os.name != "nt"))
+  directories = []
+  flags = ("-I", "-iquote", "-isystem", "/I")
+  i = 0
+  while i < len(arguments):
+    argument = arguments[i]
+    for flag in flags:
+      if argument == flag and i + 1 < len(arguments):
+        i += 1
+        directories.append(arguments[i])
+        break
+      if argument.startswith(flag) and len(argument) > len(flag):
+        directories.append(argument[len(flag):])
+        break
+    i += 1
+  if not normalize:
+    return [os.path.join(entry["directory"], d) for d in directories]
+  return [Template.makeAbsolute(d, entry["directory"]) for d in directories]
+
+## Class to find the files a translation unit depends upon by scanning for
+#  #include directives. Only files inside the repository are followed.
+class IncludeScanner:
+  pattern = re.compile(
+      rb"^[ \t]*#[ \t]*include[ \t]*([<\"])([^>\"\n]+)[>\"]", re.M)
+
+  ## Initialize an include scanner
+  #  @param self object pointer
+  #  @param root directory of the repository, includes outside are ignored
+  #  @param cache Template.Cache to save scanned includes to, None will not save
+  def __init__(self, root, cache=None):
+    self.root = os.path.join(os.path.normpath(root), "")
+    self.cache = cache
+    self.includes = {}
+
+  ## Get the #include directives of a file
+  #  @param self object pointer
+  #  @param path absolute path of file to scan
+  #  @return list of (name, quoted) tuples
+  def getIncludes(self, path):
+    if path in self.includes:
+      return self.includes[path]
+    if path in stagedContent:
+      with open(stagedContent[path], "rb") as file:
+        includes = [(match[2].decode(errors="replace"), match[1] == b"\"")
+                    for match in self.pattern.finditer(file.read())]
+      self.includes[path] = includes
+      return includes
+    info = os.stat(path)
+    stamp = (info.st_mtime_ns, info.st_size)
+    cached = self.cache.get(("includes", path)) if self.cache else None
+    if cached and cached[0] == stamp:
+      includes = cached[1]
+    else:
+      with open(path, "rb") as file:
+        includes = [(match[2].decode(errors="replace"), match[1] == b"\"")
+                    for match in self.pattern.finditer(file.read())]
+      if self.cache:
+        self.cache.set(("includes", path), (stamp, includes))
+    self.includes[path] = includes
+    return includes
+
+  ## Resolve an #include directive to a file
+  #  @param self object pointer
+  #  @param name of the included file
+  #  @param quoted true for #include "name", false for #include <name>
+  #  @param directory of the file with the #include directive as opened
+  #  @param includeDirectories list of directories searched as the compiler
+  #    joins them
+  #  @return tuple (absolute path of the included file, path the compiler opens
+  #    it with), None if not found in the repository
+  def resolve(self, name, quoted, directory, includeDirectories):
+    searchPath = includeDirectories
+    if quoted:
+      searchPath = [directory] + includeDirectories
+    for d in searchPath:
+      opened = os.path.join(d, name)
+      path = os.path.normpath(opened)
+      if path.startswith(self.root) and \
+          (path in stagedContent or os.path.isfile(path)):
+        return path, opened
+    return None
+
+  ## Get the paths the compiler opens the files a translation unit includes
+  #  with, directly or indirectly. The paths are not normalized, a file may be
+  #  opened with several.
+  #  @param self object pointer
+  #  @param name absolute path of the translation unit
+  #  @param entry of the compilation database for the translation unit
+  #  @return dictionary {absolute path of file: set of paths opened}
+  def getOpenedPaths(self, name, entry):
+    includeDirectories = getIncludeDirectories(entry, normalize=False)
+    opened = {name: {os.path.join(entry["directory"], entry["file"])}}
+    stack = [(name, next(iter(opened[name])))]
+    while stack:
+      path, openedPath = stack.pop()
+      for include, quoted in self.getIncludes(path):
+        resolved = self.resolve(include, quoted, os.path.dirname(openedPath),
+                                includeDirectories)
+        if not resolved:
+          continue
+        if resolved[0] not in opened:
+          opened[resolved[0]] = set()
+          stack.append(resolved)
+        opened[resolved[0]].add(resolved[1])
+    return opened
+
+  ## Get every file a translation unit includes, directly or indirectly
+  #  @param self object pointer
+  #  @param name absolute path of the translation unit
+  #  @param entry of the compilation database for the translation unit
+  #  @return set of absolute paths of included files
+  def getDependencies(self, name, entry):
+    dependencies = set(self.getOpenedPaths(name, entry))
+    dependencies.discard(name)
+    return dependencies
+
+## Get the translation units affected by changed files: changed translation
+#  units and those including a changed file
+#  @param files list of changed files
+#  @param compileCommands CompileDatabase to look up compile commands in
+#  @param scanner IncludeScanner to find dependencies with
+#  @param pattern regex translation units need to match
+#  @return list of absolute paths of translation units to tidy
+def getDependentFiles(files, compileCommands, scanner, pattern):
+  changed = set(files)
+  dependents = [name for name in files if name in compileCommands]
+  headers = changed.difference(dependents)
+  if not headers:
+    return dependents
+  for name, entry in compileCommands.items():
+    if name in changed or not pattern.match(name) or not os.path.isfile(name):
+      continue
+    if not headers.isdisjoint(scanner.getDependencies(name, entry)):
+      dependents.append(name)
+  return dependents
 
 ## Create argument menu and parse from command arguments
 #  @return object of arguments
@@ -92,8 +436,6 @@ def getArguments():
                       help="path to clang-format binary")
   parser.add_argument("--clang-tidy", metavar="PATH", default="clang-tidy",
                       help="path to clang-tidy binary")
-  parser.add_argument("--clang-apply-replacements", metavar="PATH", default="clang-apply-replacements",
-                      help="path to clang-apply-replacements binary")
   parser.add_argument("--git", metavar="PATH", default="git",
                       help="path to git binary")
   parser.add_argument("--regex", metavar="PATTERN", default=r"^((?!test).)*\.(cpp|cc|c\+\+|cxx|c|h|hpp)$",
@@ -102,27 +444,78 @@ def getArguments():
                       "\"^((?!(third-party|lib)).)*\\.(cpp|cc|c\\+\\+|cxx|c|h|hpp)$\"")
   parser.add_argument("-j", type=int, default=multiprocessing.cpu_count(),
                       help="number of clang-format instances to be run in parallel.")
+  parser.add_argument("--format-batch", metavar="N", type=int, default=0,
+                      help="number of files passed to each clang-format "
+                      "instance, default chooses from the file count and -j")
   parser.add_argument("-a", action="store_true", default=False,
                       help="check all user files, overrides --index")
   parser.add_argument("-p", metavar="PATH", default="./build/",
                       help="Path used to read a compile command database.")
   parser.add_argument("--staged", action="store_true", default=False,
-                      help="only check files added to the stage (git add FILE)")
+                      help="only check files added to the stage (git add FILE), "
+                      "checking their staged content")
+  parser.add_argument("--lines-changed", action="store_true", default=False,
+                      help="only check the lines changed according to git diff, "
+                      "untracked files are checked entirely")
   parser.add_argument("--fix", action="store_true", default=False,
                       help="apply formatting fixes")
+  parser.add_argument("--cache", metavar="PATH", default="./build/.Clang-TidyFormat.cache",
+                      help="path to save results to, files unchanged since "
+                      "their last check are not checked again")
+  parser.add_argument("--no-cache", action="store_true", default=False,
+                      help="check every file, ignoring and not saving results")
+  parser.add_argument("--report", metavar="PATH", default=None,
+                      help="write the time and resources each file and phase "
+                      "took to a JSON file")
+  parser.add_argument("--sarif", metavar="PATH", default=None,
+                      help="write the clang-tidy diagnostics to a SARIF log, "
+                      "each once even if reported by several files")
+  parser.add_argument("--diagnostics-json", metavar="PATH", default=None,
+                      help="write the clang-tidy diagnostics to a compact JSON "
+                      "file, each once even if reported by several files")
+  parser.add_argument("--watch", action="store_true", default=False,
+                      help="keep running, checking files as they are modified "
+                      "and serving the verdict to --query")
+  parser.add_argument("--watch-interval", metavar="SECONDS", type=float, default=0.5,
+                      help="time between checks for modified files")
+  parser.add_argument("--query", action="store_true", default=False,
+                      help="print the verdict of a running --watch and exit, "
+                      "exit code 2 when none is running")
+  parser.add_argument("--server", metavar="PATH", default="./build/.Clang-TidyFormat.server",
+                      help="path to save the address of a running --watch to")
+  parser.add_argument("--fail-fast", action="store_true", default=False,
+                      help="stop at the first file failing a check, killing "
+                      "the checks still running")
   parser.add_argument("--quiet", action="store_true", default=False,
                       help="only output errors")
   parser.add_argument("-v", action="store_true", default=False,
                       help="output commands being run")
+  parser.add_argument("--refresh-probes", action="store_true", default=False,
+                      help="probe each binary even if a previous result is cached")
 
   argv = sys.argv[1:]
   args = parser.parse_args(argv)
 
+  if args.query:
+    return args
+
   if not args.tidy and not args.format:
     print("Need --tidy and/or --format flag", file=sys.stderr)
     parser.print_help()
     sys.exit(1)
 
+  if args.lines_changed and args.a:
+    print("--lines-changed cannot be used with -a", file=sys.stderr)
+    sys.exit(1)
+
+  if args.watch and args.fix:
+    print("--watch cannot be used with --fix", file=sys.stderr)
+    sys.exit(1)
+
+  if args.fail_fast and args.fix:
+    print("--fail-fast cannot be used with --fix", file=sys.stderr)
+    sys.exit(1)
+
   if args.tidy:
     args.p = Template.findInParent("compile_commands.json", args.p)
 
@@ -133,252 +526,1478 @@ def getArguments():
       git=args.git,
       clangFormat=args.clang_format,
       clangTidy=args.clang_tidy,
-      clangApplyReplacements=args.clang_apply_replacements,
-      quiet=args.quiet)
+      quiet=args.quiet,
+      refresh=args.refresh_probes)
 
   return args
 
-## Thread to run clang-tidy
+## Class to hold the outcome of a command
+class CommandResult:
+  ## Initialize a command result
+  #  @param self object pointer
+  #  @param returnCode of the command, None when it could not be started
+  #  @param output stdout of the command
+  #  @param err stderr of the command
+  #  @param wallTime seconds the command took to run
+  #  @param cpuTime seconds of user and system CPU time, None if not measured
+  #  @param maxRSS peak resident set size in bytes, None if not measured
+  #  @param cancelled true when the command was skipped or killed by
+  #    Scheduler.fail, its outcome is unknown
+  def __init__(self, returnCode=None, output="", err="", wallTime=0.0,
+               cpuTime=None, maxRSS=None, cancelled=False):
+    self.returnCode = returnCode
+    self.output = output
+    self.err = err
+    self.wallTime = wallTime
+    self.cpuTime = cpuTime
+    self.maxRSS = maxRSS
+    self.cancelled = cancelled
+
+## Class to share the console between concurrent commands. The block of
+#  output that writes first owns the console and prints its lines as they
+#  arrive, the others hold theirs until they own it, so the output of each
+#  file stays together.
+class Console:
+  ## Number of characters a waiting block holds in memory, the rest is held
+  #  in a temporary file
+  bufferSize = 1 << 16
+
+  ## Initialize a console
+  #  @param self object pointer
+  def __init__(self):
+    self.owner = None
+    self.waiting = []
+
+  ## Open a block of output
+  #  @param self object pointer
+  #  @param header text written before the first text of the block
+  #  @return OutputBlock
+  def open(self, header=""):
+    return OutputBlock(self, header)
+
+  ## Print a complete block of output
+  #  @param self object pointer
+  #  @param text to print, a newline is added
+  def print(self, text):
+    block = self.open()
+    block.write(text + "\n")
+    block.close()
+
+  ## Write text of a block, printing it if the block owns the console
+  #  @param self object pointer
+  #  @param block OutputBlock writing
+  #  @param text to write
+  def write(self, block, text):
+    if self.owner is None:
+      self.owner = block
+    if self.owner is block:
+      sys.stdout.write(text)
+      sys.stdout.flush()
+      return
+    if block.buffer is None:
+      block.buffer = tempfile.SpooledTemporaryFile(self.bufferSize, "w+")
+      self.waiting.append(block)
+    block.buffer.write(text)
+
+  ## Close a block, handing the console to the block that waited longest
+  #  @param self object pointer
+  #  @param block OutputBlock closing
+  def close(self, block):
+    if self.owner is not block:
+      return
+    self.owner = None
+    while self.waiting:
+      block = self.waiting.pop(0)
+      block.buffer.seek(0)
+      shutil.copyfileobj(block.buffer, sys.stdout)
+      sys.stdout.flush()
+      block.buffer.close()
+      block.buffer = None
+      if not block.closed:
+        self.owner = block
+        break
+
+## Class to write a block of output to a Console
+class OutputBlock:
+  ## Initialize a block, see Console.open
+  #  @param self object pointer
+  #  @param console to write to
+  #  @param header text written before the first text of the block
+  def __init__(self, console, header=""):
+    self.console = console
+    self.header = header
+    self.written = False
+    self.closed = False
+    self.buffer = None
+
+  ## Write text
+  #  @param self object pointer
+  #  @param text to write
+  def write(self, text):
+    if not self.written:
+      self.written = True
+      text = self.header + text
+    self.console.write(self, text)
+
+  ## Close the block, no text is written after
+  #  @param self object pointer
+  def close(self):
+    if not self.closed:
+      self.closed = True
+      self.console.close(self)
+
+## Class to run commands concurrently, at most a fixed number at a time, shared
+#  between all jobs so format and tidy can run side by side
+class Scheduler:
+  ## Number of characters of each stream of a command kept in its
+  #  CommandResult, lines after are only passed on as they arrive
+  outputLimit = 1 << 20
+
+  ## Initialize a scheduler, must be called from within the event loop
+  #  @param self object pointer
+  #  @param maxTasks number of parallel commands to execute
+  #  @param verbose true will print commands
+  #  @param usage true will measure CPU time and peak memory of each command,
+  #    where supported by the platform
+  #  @param failFast true will cancel the commands left once fail is called
+  def __init__(self, maxTasks, verbose, usage=False, failFast=False):
+    self.maxTasks = maxTasks
+    self.verbose = verbose
+    self.usage = usage and hasattr(os, "wait4")
+    self.failFast = failFast
+    self.semaphore = asyncio.Semaphore(maxTasks)
+    self.console = Console()
+    self.running = set()
+    self.killed = set()
+    self.stopped = False
+
+  ## Report a failing check, with failFast the commands running are killed and
+  #  those not started are skipped
+  #  @param self object pointer
+  #  @param spare process that failed, it is left to finish its output
+  def fail(self, spare=None):
+    if not self.failFast or self.stopped:
+      return
+    self.stopped = True
+    print("Stopping at the first failure (--fail-fast)", file=sys.stderr,
+          flush=True)
+    for proc in self.running:
+      if proc is spare:
+        continue
+      self.killed.add(proc)
+      try:
+        proc.kill()
+      except ProcessLookupError:
+        pass
+
+  ## Wrap the line handler of a command to call fail when a line fails a check
+  #  @param self object pointer
+  #  @param proc process of the command
+  #  @param onLine function(line) returning true when the line fails a check,
+  #    None for no handler
+  #  @return function(line), None for no handler
+  def watchLines(self, proc, onLine):
+    if onLine is None:
+      return None
+    ## Pass a line to the handler
+    #  @param line of output
+    def handle(line):
+      if onLine(line):
+        self.fail(proc)
+    return handle
+
+  ## Run a command once a slot is available, the command is killed if the job
+  #  is cancelled
+  #  @param self object pointer
+  #  @param cmd command to run, i.e. ["clang-format", "--version"]
+  #  @param stdin bytes to write to the command's input, None for no input
+  #  @param onLine function(line) called on each line of stdout as it arrives,
+  #    returns true when the line fails a check
+  #  @param inputPath path of a file the command reads as its input in place of
+  #    stdin, not held in memory
+  #  @return CommandResult
+  async def run(self, cmd, stdin=None, onLine=None, inputPath=None):
+    async with self.semaphore:
+      if self.stopped:
+        return CommandResult(cancelled=True)
+      with contextlib.ExitStack() as stack:
+        if inputPath is not None:
+          stdin = stack.enter_context(open(inputPath, "rb"))
+        if self.verbose:
+          self.console.print(" ".join(cmd))
+        start = time.perf_counter()
+        if self.usage:
+          return await self.runWithUsage(cmd, start, stdin, onLine)
+        try:
+          proc = await asyncio.create_subprocess_exec(
+              *cmd, stdin=asyncio.subprocess.PIPE if isinstance(stdin, bytes)
+              else stdin,
+              stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        except Exception:
+          return CommandResult()
+        self.running.add(proc)
+        try:
+          jobs = [readStream(proc.stdout, self.watchLines(proc, onLine),
+                             self.outputLimit),
+                  readStream(proc.stderr, None, self.outputLimit)]
+          if isinstance(stdin, bytes):
+            jobs.append(writeStream(proc.stdin, stdin))
+          output, err = (await asyncio.gather(*jobs))[:2]
+          await proc.wait()
+        except asyncio.CancelledError:
+          proc.kill()
+          await proc.wait()
+          raise
+        finally:
+          self.running.discard(proc)
+      return CommandResult(proc.returncode, output, err,
+                           time.perf_counter() - start,
+                           cancelled=proc in self.killed)
+
+  ## Run a command, reaping it with wait4 to get its resource usage. asyncio's
+  #  child watcher does not expose the usage so the process is waited upon in
+  #  an executor instead.
+  #  @param self object pointer
+  #  @param cmd command to run
+  #  @param start time.perf_counter() when the command was requested
+  #  @param stdin bytes to write to the command's input, a file object it reads
+  #    as its input, None for no input
+  #  @param onLine function(line) called on each line of stdout as it arrives,
+  #    returns true when the line fails a check
+  #  @return CommandResult
+  async def runWithUsage(self, cmd, start, stdin=None, onLine=None):
+    try:
+      proc = subprocess.Popen(
+          cmd, stdin=subprocess.PIPE if isinstance(stdin, bytes) else stdin,
+          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except Exception:
+      return CommandResult()
+    loop = asyncio.get_event_loop()
+    self.running.add(proc)
+    try:
+      jobs = [readPipe(proc.stdout, self.watchLines(proc, onLine),
+                       self.outputLimit),
+              readPipe(proc.stderr, None, self.outputLimit)]
+      if isinstance(stdin, bytes):
+        jobs.append(loop.run_in_executor(None, writePipe, proc.stdin, stdin))
+      output, err = (await asyncio.gather(*jobs))[:2]
+    except asyncio.CancelledError:
+      proc.kill()
+      await loop.run_in_executor(None, os.wait4, proc.pid, 0)
+      proc.returncode = -9
+      raise
+    finally:
+      # Not killed once reaped, its pid could be reused
+      self.running.discard(proc)
+    _, status, usage = await loop.run_in_executor(None, os.wait4, proc.pid, 0)
+    if os.WIFSIGNALED(status):
+      proc.returncode = -os.WTERMSIG(status)
+    else:
+      proc.returncode = os.WEXITSTATUS(status)
+    # ru_maxrss is in kilobytes except on macOS
+    maxRSS = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return CommandResult(proc.returncode, output, err,
+                         time.perf_counter() - start,
+                         usage.ru_utime + usage.ru_stime, maxRSS,
+                         proc in self.killed)
+
+## Read a stream of a child process line by line until it is closed
+#  @param reader asyncio.StreamReader to read
+#  @param onLine function(line) called on each line as it arrives, None will
+#    only collect the lines
+#  @param limit number of characters to keep, None keeps all
+#  @return string of the lines kept with universal newlines
+async def readStream(reader, onLine=None, limit=None):
+  decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+  kept = []
+  size = 0
+  truncated = False
+  remainder = ""
+  while True:
+    chunk = await reader.read(1 << 16)
+    text = remainder + decoder.decode(chunk, not chunk)
+    lines = text.split("\n")
+    # The last piece is the start of a line still to come, or at the end of
+    # the stream a line without a newline
+    remainder = lines.pop()
+    lines = [line + "\n" for line in lines]
+    if not chunk and remainder:
+      lines.append(remainder)
+    for line in lines:
+      line = line.replace("\r\n", "\n")
+      if onLine:
+        onLine(line)
+      if truncated:
+        continue
+      if limit is not None and size + len(line) > limit:
+        truncated = True
+        kept.append("[output truncated]\n")
+        continue
+      kept.append(line)
+      size += len(line)
+    if not chunk:
+      return "".join(kept)
+
+## Read a pipe of a child process line by line until it is closed
+#  @param pipe file object to read
+#  @param onLine function(line) called on each line as it arrives, None will
+#    only collect the lines
+#  @param limit number of characters to keep, None keeps all
+#  @return string of the lines kept with universal newlines
+async def readPipe(pipe, onLine=None, limit=None):
+  loop = asyncio.get_event_loop()
+  reader = asyncio.StreamReader()
+  transport, _ = await loop.connect_read_pipe(
+      lambda: asyncio.StreamReaderProtocol(reader), pipe)
+  try:
+    return await readStream(reader, onLine, limit)
+  finally:
+    transport.close()
+
+## Write to the input of a child process, then close it
+#  @param writer asyncio.StreamWriter to write
+#  @param data bytes to write
+async def writeStream(writer, data):
+  try:
+    writer.write(data)
+    await writer.drain()
+    writer.close()
+  except (BrokenPipeError, ConnectionResetError):
+    # The process exited without reading everything, its result tells why
+    pass
+
+## Write to a pipe of a child process, then close it
+#  @param pipe file object to write
+#  @param data bytes to write
+def writePipe(pipe, data):
+  try:
+    pipe.write(data)
+    pipe.close()
+  except BrokenPipeError:
+    # The process exited without reading everything, its result tells why
+    pass
+
+## Class to collect the time and resources each part of a run takes, written
+#  as a machine readable report
+class Report:
+  ## Initialize a report
+  #  @param self object pointer
+  def __init__(self):
+    self.phases = {}
+    self.tidy = []
+    self.format = []
+
+  ## Time a phase of the run, use as a context manager
+  #  @param self object pointer
+  #  @param name of the phase
+  @contextlib.contextmanager
+  def phase(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.phases[name] = self.phases.get(name, 0.0) + \
+          time.perf_counter() - start
+
+  ## Add the result of tidying a file
+  #  @param self object pointer
+  #  @param name of file tidied
+  #  @param tidy true if the file has no diagnostics and clang-tidy succeeded
+  #  @param diagnostics list of Diagnostics.Diagnostic of the file
+  #  @param result CommandResult of clang-tidy, None if replayed from the cache
+  def addTidy(self, name, tidy, diagnostics, result=None):
+    record = {"file": name,
+              "cached": result is None,
+              "tidy": tidy,
+              "diagnostics": len(diagnostics)}
+    if result:
+      record.update(self.getUsage(result))
+    self.tidy.append(record)
+
+  ## Add the result of formatting a batch of files
+  #  @param self object pointer
+  #  @param replacements dictionary of file: number of replacements
+  #  @param result CommandResult of clang-format, None if replayed from the cache
+  def addFormat(self, replacements, result=None):
+    record = {"files": sorted(replacements),
+              "cached": result is None,
+              "replacements": replacements}
+    if result:
+      record.update(self.getUsage(result))
+    self.format.append(record)
+
+  ## Get the resource usage fields of a record
+  #  @param result CommandResult
+  #  @return dictionary of fields
+  @staticmethod
+  def getUsage(result):
+    return {"wallTime": result.wallTime,
+            "cpuTime": result.cpuTime,
+            "maxRSS": result.maxRSS,
+            "returnCode": result.returnCode}
+
+  ## Write the report as JSON
+  #  @param self object pointer
+  #  @param path to write to
+  def write(self, path):
+    jobs = [record for record in self.tidy + self.format if not record["cached"]]
+    totals = {
+        "tidyFiles": len(self.tidy),
+        "tidyCached": sum(record["cached"] for record in self.tidy),
+        "diagnostics": sum(record["diagnostics"] for record in self.tidy),
+        "formatFiles": sum(len(record["files"]) for record in self.format),
+        "formatCached": sum(len(record["files"])
+                            for record in self.format if record["cached"]),
+        "replacements": sum(sum(record["replacements"].values())
+                            for record in self.format),
+        "commands": len(jobs),
+        "wallTime": sum(record["wallTime"] for record in jobs),
+        "cpuTime": sum(record["cpuTime"] or 0.0 for record in jobs),
+        "maxRSS": max([record["maxRSS"] or 0 for record in jobs] + [0])}
+    data = {"phases": self.phases, "totals": totals,
+            "tidy": self.tidy, "format": self.format}
+    with open(path, "w", newline="\n") as file:
+      json.dump(data, file, indent=2)
+      file.write("\n")
+
+## Print a list of commands that failed
+#  @param failedCommands list of commands
+def printFailedCommands(failedCommands):
+  print("Failed executing commands:", file=sys.stderr)
+  for cmd in failedCommands:
+    print(" ".join(cmd), file=sys.stderr)
+
+## Class to print the output of tidying a file, parsing its diagnostics as
+#  they arrive. A diagnostic already printed for another translation unit,
+#  i.e. in a header both include, is not printed again.
+class TidyOutput:
+  ## Initialize the output of a file
+  #  @param self object pointer
+  #  @param console to print to
+  #  @param name of file tidied
+  #  @param diagnostics Diagnostics.DiagnosticSet of every file tidied
+  #  @param directory of the compile command relative paths are relative to,
+  #    None for the current directory
+  def __init__(self, console, name, diagnostics, directory=None):
+    self.block = console.open("Tidying {}\n".format(name))
+    self.name = name
+    self.parser = Diagnostics.Parser(directory)
+    self.diagnostics = diagnostics
+
+  ## Write a line of clang-tidy's stdout
+  #  @param self object pointer
+  #  @param line of output
+  #  @return true if the line starts a diagnostic
+  def write(self, line):
+    diagnostic, started = self.parser.feed(line)
+    if started:
+      self.diagnostics.add(diagnostic, self.name)
+    if diagnostic is None or not diagnostic.duplicate:
+      self.block.write(line)
+    return started
+
+  ## Finish the output
+  #  @param self object pointer
+  #  @param err stderr of clang-tidy
+  #  @param quiet true will only print errors
+  #  @param verbose true will print commands
+  def close(self, err, quiet, verbose):
+    if not quiet or self.block.written:
+      self.block.write("\n")
+    if len(err) > 0 and ("warnings generated" not in err or verbose):
+      self.block.write(err + "\n")
+    self.block.close()
+
+## Print the result of tidying a file
+#  @param console to print to
+#  @param name of file tidied
+#  @param output stdout of clang-tidy
+#  @param err stderr of clang-tidy
+#  @param quiet true will only print errors
+#  @param verbose true will print commands
+#  @param diagnostics Diagnostics.DiagnosticSet of every file tidied
+#  @param directory of the compile command relative paths are relative to,
+#    None for the current directory
+#  @return list of Diagnostics.Diagnostic of the file
+def printTidyResult(console, name, output, err, quiet, verbose, diagnostics,
+                    directory=None):
+  tidyOutput = TidyOutput(console, name, diagnostics, directory)
+  for line in output.splitlines(True):
+    tidyOutput.write(line)
+  tidyOutput.close(err, quiet, verbose)
+  return tidyOutput.parser.diagnostics
+
+## Run clang-tidy on a file
+#  @param scheduler to run clang-tidy with
 #  @param clangTidy executable
-#  @param queue of files
-#  @param lock of stdout
-#  @param failedCommands list of commands that encountered an exception
+#  @param name of file to tidy
 #  @param compilationDatabase to pass to clang-tidy to check compilation
 #  @param tmpdir location to export list of fixes to
 #  @param quiet true will only print errors
 #  @param verbose true will print commands
-#  @param anyNotTidy when file is not tidy set true, else nothing
-def runTidy(clangTidy, queue, lock, failedCommands,
-            compilationDatabase, tmpdir, quiet, verbose, anyNotTidy):
-  while True:
-    name = queue.get()
+#  @param lineFilter list for -line-filter restricting diagnostics to files and
+#    line ranges, None will report all diagnostics
+#  @param overlay path of a virtual file system overlay to read files through,
+#    None reads the working tree
+#  @param diagnostics Diagnostics.DiagnosticSet to add the file's diagnostics
+#    to, None will not collect them
+#  @param headerFilter regex for -header-filter of the headers to report
+#    diagnostics in, None uses the configuration's HeaderFilterRegex
+#  @param directory of the compile command relative paths are relative to,
+#    None for the current directory
+#  @return tuple (command, CommandResult, (tidy, output, err), list of
+#    Diagnostics.Diagnostic), tidy result is None if clang-tidy failed to run
+async def runTidy(scheduler, clangTidy, name, compilationDatabase, tmpdir,
+                  quiet, verbose, lineFilter=None, overlay=None,
+                  diagnostics=None, headerFilter=None, directory=None):
+  cmd = [clangTidy, "-p", compilationDatabase, "-quiet"]
+  if overlay:
+    cmd.append("-vfsoverlay=" + overlay)
+  if headerFilter is not None:
+    cmd.append("-header-filter=" + headerFilter)
+  if lineFilter is not None:
+    cmd.append("-line-filter=" + json.dumps(lineFilter))
+  if tmpdir:
+    cmd.append("-export-fixes")
+    # Get a temporary file. We immediately close the handle so clang-tidy can
+    # overwrite it.
+    (handle, tmpfile) = tempfile.mkstemp(suffix=".yaml", dir=tmpdir)
+    os.close(handle)
+    cmd.append(tmpfile)
+  cmd.append(name)
 
-    cmd = [clangTidy, "-p", compilationDatabase, "-quiet"]
-    if tmpdir:
-      cmd.append("-export-fixes")
-      # Get a temporary file. We immediately close the handle so clang-tidy can
-      # overwrite it.
-      (handle, tmpfile) = tempfile.mkstemp(suffix=".yaml", dir=tmpdir)
-      os.close(handle)
-      cmd.append(tmpfile)
-    cmd.append(name)
-
-    if verbose:
-      with lock:
-        print(" ". join(cmd))
-    try:
-      proc = subprocess.Popen(
-          cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-    except Exception:
-      queue.task_done()
-      failedCommands.append(" ".join(cmd))
+  # Diagnostics are printed as they arrive, the first one stops the run with
+  # --fail-fast
+  tidyOutput = TidyOutput(scheduler.console, name,
+                          diagnostics or Diagnostics.DiagnosticSet(), directory)
+  try:
+    result = await scheduler.run(cmd, onLine=tidyOutput.write)
+    if result.returnCode is not None and not result.cancelled:
+      tidyOutput.close(result.err, quiet, verbose)
+  finally:
+    tidyOutput.block.close()
+  fileDiagnostics = tidyOutput.parser.diagnostics
+  if result.returnCode != 0:
+    if not result.cancelled:
+      scheduler.fail()
+    return cmd, result, None, fileDiagnostics
+  return cmd, result, (len(fileDiagnostics) == 0, result.output,
+                       result.err), fileDiagnostics
+
+## Estimate how long clang-tidy takes on each file from the time it took on
+#  previous runs. Files without a history are estimated from the amount of
+#  source they parse, themselves and the files they include.
+#  @param files list of files to estimate
+#  @param compileCommands CompileDatabase to look up compile commands in
+#  @param cache Template.Cache of previous times, None will estimate every file
+#  @param scanner IncludeScanner to find included files with, None will only
+#    consider the file itself
+#  @return dictionary of file: estimated seconds
+def getTidyCosts(files, compileCommands, cache, scanner):
+  costs = {}
+  sizes = {}
+  for name in files:
+    history = cache.get(("tidyTime", name)) if cache else None
+    size = 0
+    for path in [name] + sorted(scanner.getDependencies(
+        name, compileCommands[name]) if scanner else []):
+      size += os.path.getsize(stagedContent.get(path, path))
+    sizes[name] = size
+    if history is not None:
+      costs[name] = history
+
+  # Convert sizes to seconds using the median rate of files with a history
+  rates = sorted(costs[name] / max(sizes[name], 1) for name in costs)
+  rate = rates[len(rates) // 2] if rates else 1.0
+  for name in files:
+    if name not in costs:
+      costs[name] = sizes[name] * rate
+  return costs
+
+## Get the -line-filter of a translation unit, restricting diagnostics to the
+#  changed lines of itself and the changed headers it owns
+#  @param name of the translation unit
+#  @param dependencies set of headers the translation unit reports diagnostics
+#    in
+#  @param changedFiles set of changed files, those without line ranges are
+#    checked entirely
+#  @param lines dictionary of file: list of changed [first, last] line ranges
+#  @return list of filter objects
+def getLineFilter(name, dependencies, changedFiles, lines):
+  lineFilter = []
+  paths = sorted(dependencies.intersection(changedFiles))
+  if name in changedFiles:
+    paths.insert(0, name)
+  for path in paths:
+    if path in lines:
+      lineFilter.append({"name": path, "lines": lines[path]})
+    else:
+      lineFilter.append({"name": path})
+  return lineFilter
+
+## Get the regular expression of the headers clang-tidy reports diagnostics
+#  in, the HeaderFilterRegex of the configuration of a directory
+#  @param directory to get the configuration of
+#  @return compiled regex, None if no header is reported
+@functools.lru_cache(maxsize=None)
+def getHeaderFilterRegex(directory):
+  content = getConfigContent(".clang-tidy", directory).decode(errors="replace")
+  matches = re.search(r"^HeaderFilterRegex:[ \t]*(['\"]?)(.*?)\1[ \t]*$",
+                      content, re.M)
+  if not matches or not matches[2]:
+    return None
+  try:
+    return re.compile(matches[2])
+  except re.error:
+    return None
+
+## Get the headers each translation unit reports diagnostics in. clang-tidy
+#  matches HeaderFilterRegex against the path the compiler opened the header
+#  with: the #include spelling joined to the directory it was found in, as
+#  given by the compile command.
+#  @param files list of translation units
+#  @param compileCommands CompileDatabase to look up compile commands in
+#  @param scanner IncludeScanner to find included files with, None will not
+#    find any header
+#  @param changedFiles set of files diagnostics are reported in, None for all
+#  @return dictionary {translation unit: set of absolute paths of headers}
+def getReportedHeaders(files, compileCommands, scanner, changedFiles=None):
+  headers = {}
+  for name in files:
+    regex = getHeaderFilterRegex(os.path.dirname(name))
+    if scanner is None or regex is None:
+      headers[name] = set()
       continue
+    opened = scanner.getOpenedPaths(name, compileCommands[name])
+    opened.pop(name)
+    headers[name] = {
+        path for path, paths in opened.items()
+        if (changedFiles is None or path in changedFiles) and
+        any(regex.search(openedPath) for openedPath in paths)}
+  return headers
 
-    output, err = proc.communicate()
-    if proc.returncode != 0:
-      failedCommands.append(" ".join(cmd))
-    with lock:
-      if not quiet or len(output) > 0:
-        print("Tidying", name)
-        print(output, flush=True)
-        anyNotTidy = True
-      if "warnings generated" not in err or verbose:
-        print(err, flush=True)
-        anyNotTidy = True
-    queue.task_done()
-
-## Tidy files in parallel
+## Get the -header-filter of a translation unit, only reporting diagnostics in
+#  the headers it owns. clang-tidy matches the path the header was opened with,
+#  so each header is matched by the end of it, its path relative to the
+#  repository.
+#  @param headers set of absolute paths of owned headers
+#  @param root directory of the repository ending with a separator
+#  @return regex string, POSIX extended syntax
+def getHeaderFilter(headers, root):
+  if not headers:
+    return "^$"
+  separator = "[/\\\\]" if os.sep == "\\" else "/"
+  paths = []
+  for path in sorted(headers):
+    if path.startswith(root):
+      path = path[len(root):]
+    parts = [re.sub(r"([.^$|()\[\]{}*+?\\])", r"\\\1", part)
+             for part in path.split(os.sep)]
+    paths.append(separator.join(parts))
+  return "(^|{})({})$".format(separator, "|".join(paths))
+
+## Split the diagnostics of a translation unit into those in the headers it
+#  owns and the rest
+#  @param fileDiagnostics list of Diagnostics.Diagnostic of the translation unit
+#  @param headers set of absolute paths of owned headers
+#  @return tuple (list of the rest, {header: list of its diagnostics})
+def splitDiagnostics(fileDiagnostics, headers):
+  headerDiagnostics = {header: [] for header in headers}
+  rest = []
+  for diagnostic in fileDiagnostics:
+    headerDiagnostics.get(diagnostic.getAbsolutePath(), rest).append(diagnostic)
+  return rest, headerDiagnostics
+
+## Tidy files in parallel. Headers are checked through a single translation
+#  unit including them, their owner, and their results cached on their own so
+#  unchanged headers are not checked again by any translation unit.
+#  @param scheduler to run clang-tidy with
 #  @param clangTidy executable
 #  @param compilationDatabase
+#  @param compileCommands CompileDatabase to look up compile commands in
 #  @param tmpdir temporary directory to export changes to
-#  @param maxTasks number of parallel tasks to execute
 #  @param files list of files to process
 #  @param quiet true will only print errors
 #  @param verbose true will print commands
+#  @param cache Template.Cache of previous results, None will check every file
+#  @param scanner IncludeScanner to add included files to the cache key with
+#  @param report Report to add results to, None will not record results
+#  @param lines dictionary of file: list of changed [first, last] line ranges,
+#    None will report diagnostics on all lines
+#  @param changedFiles list of changed files to report diagnostics of when
+#    lines is given
+#  @param fixer TidyFixer to apply the exported fixes with as files finish
+#  @param overlay path of a virtual file system overlay to read files through,
+#    None reads the working tree
+#  @param diagnostics Diagnostics.DiagnosticSet to add the diagnostics to,
+#    each is printed once even if reported by several files
 #  @return bool true when all files are tidy, false otherwise
-def tidyFiles(clangTidy, compilationDatabase, tmpdir,
-              maxTasks, files, quiet, verbose):
-  with open(compilationDatabase, "r") as file:
-    database = json.load(file)
-  compileCommandFiles = [Template.makeAbsolute(entry["file"], entry["directory"])
-                         for entry in database]
-
-  taskQueue = queue.Queue(maxTasks)
-  failedCommands = []
-  lock = threading.Lock()
-  anyNotTidy = False
-  for _ in range(maxTasks):
-    t = threading.Thread(target=runTidy,
-                         args=(clangTidy, taskQueue, lock, failedCommands,
-                               compilationDatabase, tmpdir, quiet, verbose, anyNotTidy))
-    t.daemon = True
-    t.start()
-
-  # Fill the queue with files.
+async def tidyFiles(scheduler, clangTidy, compilationDatabase, compileCommands,
+                    tmpdir, files, quiet, verbose, cache=None, scanner=None,
+                    report=None, lines=None, changedFiles=None, fixer=None,
+                    overlay=None, diagnostics=None):
+  # Find the cached results of unchanged files. Untidy files are checked again
+  # when fixing to export their fixes.
+  results = {}
+  keys = {}
+  hits = {}
+  changedFiles = set(changedFiles or [])
+  if diagnostics is None:
+    diagnostics = Diagnostics.DiagnosticSet()
+  if cache:
+    toolVersion = getToolVersion(clangTidy)
+  files = [name for name in files if name in compileCommands]
+  headers = getReportedHeaders(files, compileCommands, scanner,
+                               changedFiles if lines is not None else None)
+
+  ## Get the key of a cached result
+  #  @param name of file, translation unit or header
+  #  @param entry of the compilation database to check the file with
+  #  @param ranges -line-filter entry of the file, None for all lines
+  #  @return hex digest string
+  def getKey(name, entry, ranges):
+    # Included files are part of the translation unit, add their content
+    extra = json.dumps(entry, sort_keys=True) + json.dumps(ranges)
+    for dependency in sorted(scanner.getDependencies(name, entry)
+                             if scanner else []):
+      extra += "\0" + dependency + "\0" + getFileDigest(dependency)
+    return getResultKey(name, toolVersion, ".clang-tidy", extra)
+
+  ## Get the -line-filter entry of a file
+  #  @param name of file
+  #  @return list of [first, last] line ranges, True for the entire file, None
+  #    if no diagnostic is reported in the file
+  def getRanges(name):
+    if lines is None or name not in changedFiles:
+      return None if lines is not None else True
+    return lines.get(name, True)
+
+  pending = []
+  for name in files:
+    if cache:
+      keys[name] = getKey(name, compileCommands[name], getRanges(name))
+      cached = cache.get(("tidy", name))
+      if cached and cached[0] == keys[name] and (cached[1] or not tmpdir):
+        hits[name] = cached
+        continue
+    pending.append(name)
+
+  # Headers without a cached result are checked through the translation unit
+  # including them with the least work assigned. The header's result depends
+  # on its includer's compile command, the first includer's is used as an
+  # approximation of them all.
+  includers = {}
   for name in files:
-    if name in compileCommandFiles:
-      taskQueue.put(name)
+    for header in headers[name]:
+      includers.setdefault(header, []).append(name)
+  costs = getTidyCosts(files, compileCommands, cache, scanner)
+  load = {name: costs[name] for name in pending}
+  owners = {}
+  headerKeys = {}
+  headerHits = {}
+  for header in sorted(includers):
+    if cache:
+      entry = compileCommands[min(includers[header])]
+      headerKeys[header] = getKey(header, entry, getRanges(header))
+      cached = cache.get(("tidyHeader", header))
+      if cached and cached[0] == headerKeys[header] and \
+          (cached[1] or not tmpdir):
+        headerHits[header] = cached
+        continue
+    candidates = [name for name in includers[header] if name in load]
+    if candidates:
+      owner = min(candidates, key=lambda name: (load[name], name))
+    else:
+      # Every includer is cached, check the cheapest again
+      owner = min(includers[header], key=lambda name: (costs[name], name))
+      hits.pop(owner)
+      pending.append(owner)
+      load[owner] = costs[owner]
+    owners.setdefault(owner, set()).add(header)
+    load[owner] += costs[owner] / (len(headers[owner]) + 1)
+
+  ## Replay a cached result
+  #  @param name of file
+  #  @param tidy true if the file had no diagnostics
+  #  @param output stdout of clang-tidy
+  #  @param err stderr of clang-tidy
+  def replay(name, tidy, output, err):
+    results[name] = (tidy, output, err)
+    # A header's paths are relative to its first includer's directory
+    entry = compileCommands[name if name in compileCommands
+                            else min(includers[name])]
+    fileDiagnostics = printTidyResult(scheduler.console, name, output, err,
+                                      quiet, verbose, diagnostics,
+                                      entry["directory"])
+    if not tidy:
+      scheduler.fail()
+    if report:
+      report.addTidy(name, tidy, fileDiagnostics)
+
+  for name in sorted(hits):
+    replay(name, *hits[name][1:])
+  for header in sorted(headerHits):
+    replay(header, *headerHits[header][1:], "")
+
+  # Report diagnostics only on the changed lines of a translation unit, the
+  # headers it owns, and the changed headers it includes that no translation
+  # unit owns. A translation unit with none of them has nothing to report.
+  lineFilters = {}
+  unowned = {}
+  if lines is not None:
+    for name in pending:
+      unowned[name] = {
+          path for path in (scanner.getDependencies(name, compileCommands[name])
+                            if scanner else set())
+          if path in changedFiles and path not in includers}
+      lineFilters[name] = getLineFilter(
+          name, owners.get(name, set()) | unowned[name], changedFiles, lines)
+    pending = [name for name in pending if lineFilters[name]]
+
+  # Start the most expensive files first so none are left running alone at
+  # the end
+  pending.sort(key=lambda name: costs[name], reverse=True)
+
+  ## Tidy a file, then hand its fixes to the fixer
+  #  @param name of file
+  #  @return tuple from runTidy
+  async def tidy(name):
+    headerFilter = None
+    if headers[name]:
+      headerFilter = getHeaderFilter(
+          owners.get(name, set()) | unowned.get(name, set()), scanner.root)
+    tidyResult = await runTidy(
+        scheduler, clangTidy, name, compilationDatabase, tmpdir, quiet, verbose,
+        lineFilters.get(name), overlay, diagnostics, headerFilter,
+        compileCommands[name]["directory"])
+    if fixer:
+      cmd = tidyResult[0]
+      await fixer.finish(name, cmd[cmd.index("-export-fixes") + 1])
+    return tidyResult
+
+  if fixer:
+    for name in pending:
+      fixer.start(name, scanner.getDependencies(name, compileCommands[name])
+                  if scanner else set())
+
+  failedCommands = []
+  cancelled = False
+  jobs = [tidy(name) for name in pending]
+  for name, (cmd, commandResult, result, fileDiagnostics) in zip(
+      pending, await asyncio.gather(*jobs)):
+    if commandResult.cancelled:
+      cancelled = True
+      continue
+    if cache and commandResult.returnCode is not None:
+      cache.set(("tidyTime", name), commandResult.wallTime)
+    if report:
+      report.addTidy(name, result is not None and result[0], fileDiagnostics,
+                     commandResult)
+    if result is None:
+      failedCommands.append(cmd)
+      continue
+
+    # Cache the owned headers' diagnostics apart from the translation unit's
+    rest, headerDiagnostics = splitDiagnostics(fileDiagnostics,
+                                               owners.get(name, set()))
+    results[name] = (len(rest) == 0,
+                     "".join(line for d in rest for line in d.lines), result[2])
+    for header, owned in headerDiagnostics.items():
+      results[header] = (len(owned) == 0,
+                         "".join(line for d in owned for line in d.lines), "")
+      if cache:
+        cache.set(("tidyHeader", header),
+                  (headerKeys[header],) + results[header][:2])
+    if cache:
+      cache.set(("tidy", name), (keys[name],) + results[name])
 
-  # Wait for all threads to be done.
-  taskQueue.join()
   if len(failedCommands) != 0:
-    print("Failed executing commands:", file=sys.stderr)
-    for cmd in failedCommands:
-      print(cmd, file=sys.stderr)
+    printFailedCommands(failedCommands)
     return False
-  return not anyNotTidy
+  return not cancelled and all(result[0] for result in results.values())
 
-## Apply changes exported from clang-tidy
-#  @param applyReplacements executable
-#  @param tmpdir directory where tidy replacements were exported
-#  @param quiet true will only print errors
-def fixTidyFiles(applyReplacements, tmpdir, quiet):
-  if not quiet:
-    print("Applying tidy fixes...")
+## Class to apply the fixes clang-tidy exports as translation units finish. A
+#  file is changed once no translation unit still to finish includes it, so
+#  the offsets of every fix to it refer to the same content.
+class TidyFixer:
+  ## Initialize a fixer
+  #  @param self object pointer
+  #  @param quiet true will only print errors
+  def __init__(self, quiet):
+    self.quiet = quiet
+    self.fixes = Replacements.FixSet()
+    self.dependencies = {}
+    self.users = {}
+    self.applied = set()
+    self.applying = []
+    self.modified = set()
+    self.conflicts = False
 
-  try:
-    cmd = [applyReplacements, "-format", "-style=file", tmpdir]
-    Template.call(cmd)
-  except Exception:
-    print("Error applying fixes.\n", file=sys.stderr)
-    traceback.print_exc()
+  ## Register a translation unit to be tidied
+  #  @param self object pointer
+  #  @param name of the translation unit
+  #  @param dependencies set of files the translation unit includes
+  def start(self, name, dependencies):
+    self.dependencies[name] = set(dependencies) | {name}
+    for path in self.dependencies[name]:
+      self.users[path] = self.users.get(path, 0) + 1
+
+  ## Add the fixes of a finished translation unit, then apply the files no
+  #  other translation unit includes concurrently
+  #  @param self object pointer
+  #  @param name of the translation unit
+  #  @param fixesPath file clang-tidy exported fixes to
+  async def finish(self, name, fixesPath):
+    loop = asyncio.get_event_loop()
+    if os.path.isfile(fixesPath) and os.path.getsize(fixesPath) > 0:
+      with open(fixesPath, "r") as file:
+        replacements = await loop.run_in_executor(
+            None, Replacements.parseFixes, file.read())
+      late = sorted({path for path, _, _, _ in replacements
+                     if path in self.applied})
+      for path in late:
+        print("Fixes to {} arrived after it was changed, not applied, run "
+              "again to apply".format(path), file=sys.stderr)
+        self.conflicts = True
+      self.fixes.add([replacement for replacement in replacements
+                      if replacement[0] not in self.applied])
+
+    for path in self.dependencies.pop(name, {name}):
+      self.users[path] -= 1
+    for path in self.fixes.getFiles():
+      if self.users.get(path) == 0 and path not in self.applied:
+        self.applied.add(path)
+        self.applying.append(loop.run_in_executor(None, self.apply, path))
+
+  ## Apply the fixes of a file, reporting overlapping fixes
+  #  @param self object pointer
+  #  @param path absolute path of file
+  def apply(self, path):
+    conflicts = self.fixes.apply(path)
+    if not conflicts:
+      self.modified.add(path)
+      return
+    self.conflicts = True
+    lines = ["Conflicting fixes to {}, none applied:".format(path)]
+    for first, second in conflicts:
+      lines.append("  offset {} length {} {!r} overlaps offset {} length {} "
+                   "{!r}".format(*first, *second))
+    print("\n".join(lines), file=sys.stderr)
+
+  ## Apply the remaining fixes, of files no translation unit was known to
+  #  include, and wait for all files to be changed
+  #  @param self object pointer
+  #  @return sorted list of files changed
+  async def close(self):
+    loop = asyncio.get_event_loop()
+    for path in self.fixes.getFiles():
+      if path not in self.applied:
+        self.applied.add(path)
+        self.applying.append(loop.run_in_executor(None, self.apply, path))
+    await asyncio.gather(*self.applying)
+    self.applying = []
+    if self.modified and not self.quiet:
+      print("Applied tidy fixes to {} files".format(len(self.modified)))
+    return sorted(self.modified)
 
-## Thread to run clang-format
+## Write a virtual file system overlay that makes clang-tidy read the staged
+#  content of files instead of their working tree
+#  @param clangTidy executable, -vfsoverlay requires version 12 or newer
+#  @param contents dictionary of file: path of the copy of its staged content
+#  @param directory to write the overlay to
+#  @return path of the overlay, None if clang-tidy does not support overlays
+def writeOverlay(clangTidy, contents, directory):
+  version = re.search(r"version (\d+)", getToolVersion(clangTidy))
+  if not version or int(version[1]) < 12:
+    print("clang-tidy older than 12 cannot read staged content, tidying the "
+          "working tree of:", file=sys.stderr)
+    for name in sorted(contents):
+      print(name, file=sys.stderr)
+    return None
+
+  roots = {}
+  for name in sorted(contents):
+    roots.setdefault(os.path.dirname(name), []).append(
+        {"type": "file", "name": os.path.basename(name),
+         "external-contents": contents[name]})
+  overlay = {"version": 0, "roots": [
+      {"type": "directory", "name": root, "contents": entries}
+      for root, entries in sorted(roots.items())]}
+  path = os.path.join(directory, "staged.yaml")
+  # JSON is a subset of the YAML LLVM reads
+  with open(path, "w") as file:
+    json.dump(overlay, file, indent=2)
+  return path
+
+## Get the number of files to pass to each clang-format instance
+#  @param count number of files to format
+#  @param maxTasks number of parallel tasks to execute
+#  @param batchSize requested batch size, 0 chooses one from count and maxTasks
+#  @return number of files per batch
+def getFormatBatchSize(count, maxTasks, batchSize=0):
+  if batchSize > 0:
+    return batchSize
+  # Aim for a few batches per task so the slowest batch does not dominate
+  return max(1, min(64, -(-count // (maxTasks * 4))))
+
+## Run clang-format on a batch of files
+#  @param scheduler to run clang-format with
 #  @param clangFormat executable
-#  @param queue of files
-#  @param lock of stdout
-#  @param failedCommands list of commands that encountered an exception
-#  @param toFormatFiles list of files that need to be formatted
+#  @param names list of files to format
 #  @param fix true will automatically apply formatting fixes
 #  @param quiet true will only print errors
-#  @param verbose true will print commands
-def runFormat(clangFormat, queue, lock, failedCommands,
-              toFormatFiles, fix, quiet, verbose):
-  while True:
-    name = queue.get()
-
-    cmd = [clangFormat, "-style=file"]
-    if fix:
-      cmd.append("-i")
-    else:
-      cmd.append("-output-replacements-xml")
-    cmd.append(name)
-
-    if verbose:
-      with lock:
-        print(" ". join(cmd))
-    try:
-      proc = subprocess.Popen(
-          cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-    except Exception:
-      queue.task_done()
-      failedCommands.append(" ".join(cmd))
-      continue
+#  @param ranges list of [first, last] line ranges to format, names must be a
+#    single file, None formats all lines
+#  @param content path of a file to check in place of the file, read through
+#    stdin, names must be a single file and fix false, None reads the file
+#  @return tuple (command, CommandResult, dictionary of file: number of
+#    replacements needed), dictionary is None if clang-format failed to run
+async def runFormat(scheduler, clangFormat, names, fix, quiet, ranges=None,
+                    content=None):
+  cmd = [clangFormat, "-style=file"]
+  if fix:
+    cmd.append("-i")
+  else:
+    cmd.append("-output-replacements-xml")
+  if ranges:
+    cmd.extend("--lines={}:{}".format(first, last) for first, last in ranges)
+  if content is None:
+    cmd.extend(names)
+  else:
+    # The name still selects the style and language
+    cmd.append("-assume-filename=" + names[0])
 
-    output, err = proc.communicate()
-    if proc.returncode != 0:
-      failedCommands.append(" ".join(cmd))
-    with lock:
-      if not quiet:
-        if fix:
-          print("Formatted", name, flush=True)
-        else:
-          print("Checked formatting of", name, flush=True)
-      if "<replacement " in output:
-        toFormatFiles.append(name)
-      if len(err) > 0:
-        print(err, file=sys.stderr, flush=True)
-    queue.task_done()
+  result = await scheduler.run(cmd, inputPath=content)
+  if result.cancelled:
+    return cmd, result, None
+  # Each file outputs its own XML document of replacements, in order
+  documents = result.output.split("<?xml")[1:]
+  if result.returnCode is not None:
+    if not quiet:
+      verb = "Formatted" if fix else "Checked formatting of"
+      scheduler.console.print("\n".join(verb + " " + name for name in names))
+    if len(result.err) > 0:
+      print(result.err, file=sys.stderr, flush=True)
+  if result.returnCode != 0 or (not fix and len(documents) != len(names)):
+    scheduler.fail()
+    return cmd, result, None
+  if fix:
+    return cmd, result, {}
+  replacements = {name: document.count("<replacement ")
+                  for name, document in zip(names, documents)}
+  if any(replacements.values()):
+    scheduler.fail()
+  return cmd, result, replacements
 
 ## Format files in parallel
+#  @param scheduler to run clang-format with
 #  @param clangFormat executable
 #  @param fix true will automatically apply formatting fixes
 #  @param quiet true will only print errors
-#  @param verbose true will print commands
-#  @param maxTasks number of parallel tasks to execute
 #  @param files list of files to process
+#  @param cache Template.Cache of previous results, None will check every file
+#  @param batchSize number of files per clang-format instance, 0 for automatic
+#  @param report Report to add results to, None will not record results
+#  @param lines dictionary of file: list of [first, last] line ranges to
+#    format, files not included are formatted entirely, None formats all lines
 #  @return bool true when all files are formatted, false otherwise
-def formatFiles(clangFormat, fix, quiet, verbose, maxTasks, files):
-  taskQueue = queue.Queue(maxTasks)
-  failedCommands = []
-  toFormatFiles = []
-  lock = threading.Lock()
-  for _ in range(maxTasks):
-    t = threading.Thread(target=runFormat,
-                         args=(clangFormat, taskQueue, lock, failedCommands,
-                               toFormatFiles, fix, quiet, verbose))
-    t.daemon = True
-    t.start()
-
-  # Fill the queue with files.
+async def formatFiles(scheduler, clangFormat, fix, quiet, files, cache=None,
+                      batchSize=0, report=None, lines=None):
+  # Replay cached results of unchanged files. Unformatted files are formatted
+  # again when fixing.
+  results = {}
+  keys = {}
+  pending = []
+  if cache:
+    toolVersion = getToolVersion(clangFormat)
+  lines = lines or {}
   for name in files:
-    taskQueue.put(name)
+    if cache:
+      keys[name] = getResultKey(name, toolVersion, ".clang-format",
+                                json.dumps(lines.get(name)))
+      cached = cache.get(("format", name))
+      if cached and cached[0] == keys[name] and not (cached[1] and fix):
+        results[name] = cached[1]
+        if not quiet:
+          scheduler.console.print("Checked formatting of " + name)
+        if cached[1]:
+          scheduler.fail()
+        if report:
+          report.addFormat({name: int(cached[1])})
+        continue
+    pending.append(name)
 
-  # Wait for all threads to be done.
-  taskQueue.join()
-  anyNotFormatted = False
+  # clang-format only accepts line ranges and content through stdin with a
+  # single file
+  single = [name for name in pending if name in lines or
+            (name in stagedContent and not fix)]
+  jobs = [runFormat(scheduler, clangFormat, [name], fix, quiet,
+                    lines.get(name), None if fix else stagedContent.get(name))
+          for name in single]
+  pending = [name for name in pending if name not in single]
+  batchSize = getFormatBatchSize(len(pending), scheduler.maxTasks, batchSize)
+  jobs.extend(runFormat(scheduler, clangFormat, pending[i:i + batchSize], fix,
+                        quiet) for i in range(0, len(pending), batchSize))
+  failedCommands = []
+  cancelled = False
+  for cmd, commandResult, batchResults in await asyncio.gather(*jobs):
+    if commandResult.cancelled:
+      cancelled = True
+      continue
+    if report:
+      report.addFormat(batchResults or {}, commandResult)
+    if batchResults is None:
+      failedCommands.append(cmd)
+      continue
+    results.update(batchResults)
+    if cache:
+      for name, replacements in batchResults.items():
+        cache.set(("format", name), (keys[name], replacements))
+
+  anyNotFormatted = cancelled
   if len(failedCommands) != 0:
-    print("Failed executing commands:", file=sys.stderr)
-    for cmd in failedCommands:
-      print(cmd, file=sys.stderr)
+    printFailedCommands(failedCommands)
     anyNotFormatted = True
 
+  toFormatFiles = [name for name in files if results.get(name)]
   if len(toFormatFiles) != 0:
-    print("Need to format:")
-    for file in toFormatFiles:
-      print(file)
+    scheduler.console.print("\n".join(["Need to format:"] + toFormatFiles))
     anyNotFormatted = True
-  elif not quiet and not fix:
-    print("No files need to be formatted")
+  elif not quiet and not fix and not cancelled:
+    scheduler.console.print("No files need to be formatted")
 
   return not anyNotFormatted
 
+## Run a coroutine to completion in a new event loop, cancelling it and any
+#  commands it is running on Ctrl-C
+#  @param coroutine to run
+#  @return value returned by coroutine
+def runAsync(coroutine):
+  if sys.platform == "win32":
+    # Subprocesses require the proactor event loop before Python 3.8
+    loop = asyncio.ProactorEventLoop()
+  else:
+    loop = asyncio.new_event_loop()
+  # Child processes are watched through the main thread's event loop
+  asyncio.set_event_loop(loop)
+  task = asyncio.ensure_future(coroutine, loop=loop)
+  try:
+    return loop.run_until_complete(task)
+  except KeyboardInterrupt:
+    task.cancel()
+    try:
+      loop.run_until_complete(task)
+    except asyncio.CancelledError:
+      pass
+    raise
+  finally:
+    asyncio.set_event_loop(None)
+    loop.close()
+
+## Await a coroutine, adding the time it takes to a phase of a report
+#  @param report Report to add the time to
+#  @param name of the phase
+#  @param coroutine to await
+#  @return value returned by coroutine
+async def timePhase(report, name, coroutine):
+  with report.phase(name):
+    return await coroutine
+
+## Check the files, formatting and tidying concurrently unless fixing
+#  @param args object of arguments
+#  @param files list of files to process
+#  @param pattern regex files need to match
+#  @param cache Template.Cache of previous results, None will check every file
+#  @param tmpdir temporary directory to export tidy changes and write staged
+#    content to, None when neither is needed
+#  @param report Report to add results and phase times to
+#  @param diagnostics Diagnostics.DiagnosticSet to add tidy diagnostics to,
+#    None will not keep them
+#  @return exit code, 0 when all checks pass
+async def checkFiles(args, files, pattern, cache, tmpdir, report,
+                     diagnostics=None):
+  scheduler = Scheduler(args.j, args.v, args.report is not None,
+                        args.fail_fast)
+  lines = None
+  if args.lines_changed:
+    with report.phase("discovery"):
+      lines = getChangedLines(args.git, args.staged)
+  jobs = []
+  if args.tidy:
+    with report.phase("compileDatabase"):
+      compileCommands = CompileDatabase.CompileDatabase(args.p).open()
+    scanner = IncludeScanner(os.getcwd(), cache)
+    tidyList = files
+    if not args.a:
+      # Changed headers are tidied through the translation units including
+      # them
+      with report.phase("discovery"):
+        tidyList = getDependentFiles(files, compileCommands, scanner, pattern)
+    overlay = None
+    if stagedContent:
+      overlay = writeOverlay(args.clang_tidy, stagedContent, tmpdir)
+    fixer = TidyFixer(args.quiet) if args.fix else None
+    jobs.append(timePhase(report, "tidy", tidyFiles(
+        scheduler, args.clang_tidy, args.p, compileCommands,
+        tmpdir if args.fix else None, tidyList, args.quiet, args.v, cache,
+        scanner, report, lines, files, fixer, overlay, diagnostics)))
+
+  results = []
+  if args.tidy and args.fix:
+    # Tidy fixes are applied before formatting
+    results.extend(await asyncio.gather(*jobs))
+    jobs = []
+    with report.phase("fix"):
+      modified = await fixer.close()
+      results.append(not fixer.conflicts)
+      # Fixes are not formatted, format the changed files in one pass
+      if modified:
+        await formatFiles(scheduler, args.clang_format, True, True, modified,
+                          None, args.format_batch)
+
+  if args.format:
+    jobs.append(timePhase(report, "format", formatFiles(
+        scheduler, args.clang_format, args.fix, args.quiet, files, cache,
+        args.format_batch, report, lines)))
+
+  results.extend(await asyncio.gather(*jobs))
+  if all(results):
+    return 0
+  return 1
+
+## Class to hold the verdict of a --watch session, shared with the server
+#  threads answering --query
+class WatchState:
+  ## Initialize a watch state
+  #  @param self object pointer
+  def __init__(self):
+    self.condition = threading.Condition()
+    self.busy = True
+    self.checks = 0
+    self.failures = {}
+
+  ## Mark the start of a check
+  #  @param self object pointer
+  def start(self):
+    with self.condition:
+      self.busy = True
+
+  ## Replace the verdict of checked files with the results of a check
+  #  @param self object pointer
+  #  @param files list of files checked
+  #  @param report Report of the check
+  #  @param exitCode of the check
+  def update(self, files, report, exitCode):
+    failures = {}
+    for record in report.tidy:
+      if not record["tidy"] or record.get("returnCode", 0) != 0:
+        failures.setdefault(record["file"], []).append("tidy")
+    for record in report.format:
+      for name, replacements in record["replacements"].items():
+        if replacements or record.get("returnCode", 0) != 0:
+          failures.setdefault(name, []).append("format")
+    with self.condition:
+      for name in files:
+        self.failures.pop(name, None)
+      for record in report.tidy:
+        self.failures.pop(record["file"], None)
+      self.failures.update(failures)
+      if exitCode != 0 and not failures:
+        self.failures["<commands>"] = ["failed"]
+      else:
+        self.failures.pop("<commands>", None)
+      self.busy = False
+      self.checks += 1
+      self.condition.notify_all()
+
+  ## Get the verdict, waiting for a running check to complete
+  #  @param self object pointer
+  #  @return dictionary of the verdict
+  def getVerdict(self):
+    with self.condition:
+      self.condition.wait_for(lambda: not self.busy)
+      return {"checks": self.checks, "failures": self.failures}
+
+## Handler of a --query connection to a --watch server
+class WatchRequestHandler(socketserver.StreamRequestHandler):
+  ## Reply to a request with the verdict as a line of JSON
+  #  @param self object pointer
+  def handle(self):
+    if self.rfile.readline().strip() == b"verdict":
+      data = self.server.state.getVerdict()
+      self.wfile.write(json.dumps(data).encode() + b"\n")
+
+## Ask a running --watch for its verdict and print it
+#  @param serverPath file the --watch saved its address to
+#  @return exit code, 0 when all checks pass, 1 when not, 2 when no --watch is
+#    running
+def queryServer(serverPath):
+  try:
+    with open(serverPath, "r") as file:
+      host, port = file.read().split()
+    with socket.create_connection((host, int(port)), timeout=5) as connection:
+      connection.sendall(b"verdict\n")
+      connection.settimeout(None)
+      with connection.makefile("rb") as stream:
+        data = json.loads(stream.readline())
+  except (OSError, ValueError):
+    print("No --watch is running", file=sys.stderr)
+    return 2
+  if not data["failures"]:
+    return 0
+  for name, reasons in sorted(data["failures"].items()):
+    print("Need to {}: {}".format(" and ".join(reasons), name))
+  return 1
+
+## Get the modification stamp of each file
+#  @param files list of files
+#  @return dictionary of file: (mtime, size), None if the file does not exist
+def getStamps(files):
+  stamps = {}
+  for name in files:
+    try:
+      info = os.stat(name)
+      stamps[name] = (info.st_mtime_ns, info.st_size)
+    except OSError:
+      stamps[name] = None
+  return stamps
+
+## Keep checking files as they are modified, polling their modification
+#  stamps, and serve the verdict to --query
+#  @param args object of arguments
+#  @param pattern regex files need to match
+#  @param extensions tuple of lowercase extensions a file must have, None to
+#    only use pattern
+#  @param cache Template.Cache of previous results, None will check every file
+def watchFiles(args, pattern, extensions, cache):
+  state = WatchState()
+  server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), WatchRequestHandler)
+  server.daemon_threads = True
+  server.state = state
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  os.makedirs(os.path.dirname(os.path.abspath(args.server)), exist_ok=True)
+  with open(args.server, "w") as file:
+    file.write("{} {}\n".format(*server.server_address))
+
+  # Modified headers are checked through the translation units including them
+  checkArgs = argparse.Namespace(**vars(args))
+  checkArgs.a = False
+
+  ## Check files and update the verdict
+  #  @param files list of files to check
+  #  @param checkArgs object of arguments to check with
+  def check(files, checkArgs):
+    state.start()
+    # Files and configurations may have changed since the last check
+    getFileDigest.cache_clear()
+    getConfigContent.cache_clear()
+    getHeaderFilterRegex.cache_clear()
+    report = Report()
+    exitCode = runAsync(checkFiles(checkArgs, files, pattern, cache, None, report))
+    state.update(files, report, exitCode)
+    if cache:
+      cache.save()
+
+  try:
+    if args.a:
+      files = getFileList(args.git, pattern, extensions)
+    else:
+      files = getChangedFileList(args.git, pattern, args.staged, extensions)
+    check(files, args)
+
+    # Watch every file the pattern selects, a file is checked once modified
+    polls = 0
+    files = getFileList(args.git, pattern, extensions)
+    stamps = getStamps(files)
+    modified = set()
+    if not args.quiet:
+      print("Watching {} files".format(len(files)), flush=True)
+    while True:
+      time.sleep(args.watch_interval)
+      polls += 1
+      if polls % 20 == 0:
+        # Pick up added files
+        files = getFileList(args.git, pattern, extensions)
+      newStamps = getStamps(files)
+      changed = {name for name, stamp in newStamps.items()
+                 if stamps.get(name) != stamp}
+      stamps = newStamps
+      if changed:
+        # Wait until the files settle before checking them
+        modified.update(changed)
+        continue
+      if modified:
+        check([name for name in sorted(modified) if stamps.get(name)],
+              checkArgs)
+        modified = set()
+  finally:
+    server.shutdown()
+    if os.path.exists(args.server):
+      os.remove(args.server)
+
 ## Main function
 def main():
   args = getArguments()
+  if args.query:
+    sys.exit(queryServer(args.server))
+
+  report = Report()
+  pattern = re.compile(args.regex, re.IGNORECASE)
+  extensions = getExtensions(args.regex)
+
+  cache = None
+  if not args.no_cache:
+    cache = Template.Cache(args.cache).open()
+
+  if args.watch:
+    try:
+      watchFiles(args, pattern, extensions, cache)
+    except KeyboardInterrupt:
+      print("\nCtrl-C detected, goodbye.")
+    finally:
+      if cache:
+        cache.save()
+    sys.exit(0)
 
   files = []
-  if args.a:
-    files = getFileList(args.git, re.compile(args.regex, re.IGNORECASE))
-  else:
-    files = getChangedFileList(
-        args.git,
-        re.compile(
-            args.regex,
-            re.IGNORECASE),
-        args.staged)
+  with report.phase("discovery"):
+    if args.a:
+      files = getFileList(args.git, pattern, extensions)
+    else:
+      files = getChangedFileList(args.git, pattern, args.staged, extensions)
 
   tmpdir = None
-  if args.tidy and args.fix:
+  # Fixes are applied to the working tree so it is what they check
+  staged = args.staged and not args.fix
+  if (args.tidy and args.fix) or staged:
     tmpdir = tempfile.mkdtemp()
 
-  exitCode = 0
-
+  diagnostics = Diagnostics.DiagnosticSet()
+  exitCode = 1
   try:
-    if args.tidy:
-      if not tidyFiles(args.clang_tidy, args.p, tmpdir,
-                       args.j, files, args.quiet, args.v):
-        exitCode = 1
-
-    if tmpdir:
-      fixTidyFiles(args.clang_apply_replacements, tmpdir, args.quiet)
-
-    if args.format:
-      if not formatFiles(args.clang_format, args.fix,
-                         args.quiet, args.v, args.j, files):
-        exitCode = 1
-
+    if staged:
+      with report.phase("discovery"):
+        stagedContent.update(getStagedContent(args.git, pattern, extensions,
+                                              tmpdir))
+    exitCode = runAsync(checkFiles(args, files, pattern, cache, tmpdir, report,
+                                   diagnostics))
   except KeyboardInterrupt:
     print("\nCtrl-C detected, goodbye.")
+  finally:
+    # Results of completed files are kept, even when interrupted
+    if cache:
+      cache.save()
     if tmpdir:
       shutil.rmtree(tmpdir)
-    os.kill(0, 9)
-
-  if tmpdir:
-    shutil.rmtree(tmpdir)
+    if args.report:
+      report.write(args.report)
+    if args.sarif:
+      diagnostics.writeSarif(args.sarif, getToolVersion(args.clang_tidy),
+                             os.getcwd())
+    if args.diagnostics_json:
+      diagnostics.writeJson(args.diagnostics_json)
 
   sys.exit(exitCode)
 
-
 if __name__ == "__main__":
   main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+## Index of a compilation database (compile_commands.json) with constant time
+#  lookups. The index is saved beside the database so later runs do not parse
+#  the JSON again until the database changes.
+
+import Template
+
+import json
+import mmap
+import os
+import pickle
+
+## Class to look up compile commands by absolute file path
+class CompileDatabase:
+  ## Version of the saved index, increment when its layout changes
+  indexVersion = 1
+
+  ## Initialize a compilation database
+  #  @param self object pointer
+  #  @param path to compile_commands.json
+  #  @param indexPath to save the index to, default is beside the database
+  def __init__(self, path, indexPath=None):
+    self.path = os.path.abspath(path)
+    self.indexPath = indexPath or self.path + ".index"
+    self.offsets = {}
+    self.entries = {}
+    self.data = None
+    self.dataStart = 0
+
+  ## Open the database, loading the saved index if the database has not changed
+  #  since it was saved, else parsing the database and saving a new index
+  #  @param self object pointer
+  #  @return self
+  def open(self):
+    info = os.stat(self.path)
+    stamp = (self.indexVersion, info.st_mtime_ns, info.st_size)
+    if not self.openIndex(stamp):
+      self.build(stamp)
+    return self
+
+  ## Load the saved index, entries are read from it when looked up
+  #  @param self object pointer
+  #  @param stamp tuple the index was saved with, (version, mtime, size)
+  #  @return true if the index was loaded, false if missing or out of date
+  def openIndex(self, stamp):
+    if not os.path.isfile(self.indexPath):
+      return False
+    try:
+      with open(self.indexPath, "rb") as file:
+        if pickle.load(file) != stamp:
+          return False
+        self.offsets = pickle.load(file)
+        self.dataStart = file.tell()
+        if self.offsets:
+          self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except Exception:
+      self.offsets = {}
+      return False
+    return True
+
+  ## Parse the database and save its index
+  #  @param self object pointer
+  #  @param stamp tuple to save the index with, (version, mtime, size)
+  def build(self, stamp):
+    with open(self.path, "rb") as file:
+      database = json.loads(file.read())
+
+    # Each entry is pickled separately so lookups only load what they need
+    blobs = []
+    offset = 0
+    for entry in database:
+      name = Template.makeAbsolute(entry["file"], entry["directory"])
+      if name in self.entries:
+        continue
+      self.entries[name] = entry
+      blob = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+      self.offsets[name] = (offset, len(blob))
+      blobs.append(blob)
+      offset += len(blob)
+
+    tmpPath = "{}.{}.tmp".format(self.indexPath, os.getpid())
+    try:
+      with open(tmpPath, "wb") as file:
+        pickle.dump(stamp, file, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(self.offsets, file, pickle.HIGHEST_PROTOCOL)
+        for blob in blobs:
+          file.write(blob)
+      os.replace(tmpPath, self.indexPath)
+    except OSError:
+      # The index only speeds up later runs, carry on without it
+      if os.path.exists(tmpPath):
+        os.remove(tmpPath)
+
+  ## Check if a file has a compile command
+  #  @param self object pointer
+  #  @param name absolute path of file
+  #  @return true if the database has an entry for the file
+  def __contains__(self, name):
+    return name in self.offsets
+
+  ## Get the compile command of a file
+  #  @param self object pointer
+  #  @param name absolute path of file
+  #  @return entry dictionary of the database, raises KeyError if not found
+  def __getitem__(self, name):
+    entry = self.entries.get(name)
+    if entry is None:
+      offset, length = self.offsets[name]
+      start = self.dataStart + offset
+      entry = pickle.loads(self.data[start:start + length])
+      self.entries[name] = entry
+    return entry
+
+  ## Iterate over the files of the database
+  #  @param self object pointer
+  #  @return iterator of absolute paths
+  def __iter__(self):
+    return iter(self.offsets)
+
+  ## Get the number of files in the database
+  #  @param self object pointer
+  #  @return number of files
+  def __len__(self):
+    return len(self.offsets)
+
+  ## Iterate over the files and compile commands of the database
+  #  @param self object pointer
+  #  @return generator of (absolute path, entry) tuples
+  def items(self):
+    for name in self.offsets:
+      yield name, self[name]
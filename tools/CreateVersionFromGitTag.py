@@ -2,72 +2,126 @@
 ## A script to fetch the latest version tag from git then append how far ahead
 #  the current repository is. Outputs to a version file.
 
+import GitReader
 import Template
 
 import argparse
+import json
+import os
 import re
+import struct
 import subprocess
 import sys
 import traceback
 from os import path
 
-## Get the version information from the git tags and repository state
+## Get the version information by reading the git directory, objects only
+#  stored in packfiles are read through a shared git cat-file
 #  @param git executable
-#  @return Template.Version object
-def getVersion(git):
-  # Most recent tag
-  cmd = [git, "describe", "--abbrev=0", "--tags"]
-  string = subprocess.check_output(cmd, universal_newlines=True).strip()
+#  @param abbrev number of hexadecimal digits of the SHA, None for git's default
+#  @return Template.Version object, None if the repository is not supported
+def getVersionDirect(git, abbrev=None):
+  directories = GitReader.getGitDirectories(".")
+  if not directories:
+    return None
+  try:
+    repository = GitReader.Repository(
+        *directories, Template.getGitObjects(git, directories[0])).open()
+    try:
+      string, ahead, head = repository.describe()
+      modified = repository.isModified(head)
+      gitSHA = repository.abbreviate(head, abbrev)
+    finally:
+      repository.save()
+  except (GitReader.UnsupportedError, OSError, ValueError):
+    return None
+  return Template.Version(string, ahead, modified, gitSHA)
 
-  # Number of commits since last tag
-  cmd = [git, "rev-list", string + "..HEAD", "--count"]
-  ahead = int(subprocess.check_output(cmd, universal_newlines=True).strip())
+## Check for untracked files, scanning for them is the slowest part of the
+#  version on a large worktree
+#  @param git executable
+#  @return true if the worktree has untracked files that are not ignored
+def hasUntrackedFiles(git):
+  cmd = [git, "ls-files", "--others", "--exclude-standard", "--directory",
+         "--no-empty-directory"]
+  return bool(subprocess.check_output(cmd, universal_newlines=True).strip())
 
-  # Current commit SHA
-  cmd = [git, "rev-parse", "--short", "HEAD"]
-  gitSHA = subprocess.check_output(cmd, universal_newlines=True).strip()
+## Get the version information from the git tags and repository state
+#  @param git executable
+#  @param untracked will consider untracked files a modification when true
+#  @param abbrev number of hexadecimal digits of the SHA, None for git's default
+#  @param direct will read the git directory instead of running git when true,
+#    falling back to git if its layout is not supported
+#  @return Template.Version object
+def getVersion(git, untracked=True, abbrev=None, direct=False):
+  version = None
+  if direct:
+    version = getVersionDirect(git, abbrev)
+  if version is None:
+    # Most recent tag, number of commits since it, current commit SHA, and if
+    # tracked files are modified, all at once
+    cmd = [git, "describe", "--tags", "--long", "--dirty"]
+    if abbrev is not None:
+      cmd.append(f"--abbrev={abbrev}")
+    description = subprocess.check_output(cmd, universal_newlines=True).strip()
+    matches = re.match(r"^(.*)-(\d+)-g([0-9a-f]+)(-dirty)?$", description)
+    if not matches:
+      raise ValueError(f"Unable to parse git describe output: {description}")
+    version = Template.Version(matches[1], int(matches[2]),
+                               matches[4] is not None, matches[3])
 
-  # Check if repository contains any modifications
-  modified = False
-  cmd = [git, "status", "-s"]
-  if subprocess.check_output(cmd, universal_newlines=True).strip():
-    modified = True
+  # Untracked files are not considered by describe
+  if not version.modified and untracked:
+    version.modified = hasUntrackedFiles(git)
 
-  return Template.Version(string, ahead, modified, gitSHA)
+  return version
 
-## Main function
-def main():
-  # Create an arg parser menu and grab the values from the command arguments
-  parser = argparse.ArgumentParser(description="Fetch the latest version tag "
-                                   "from git then append how far ahead the "
-                                   "current repository is. Optionally outputs "
-                                   "to a version file.")
-  parser.add_argument("--git", metavar="PATH", default="git",
-                      help="path to git binary")
-  parser.add_argument("--output", metavar="PATH",
-                      help="output file to write version info, default stdout")
-  parser.add_argument("--output-str", metavar="FORMAT",
-                      help="output version to stdout using the format: %%M major, %%m minor, %%p patch, %%t tweak, %%a ahead, %%~ modified, %%s SHA")
-  parser.add_argument("--quiet", action="store_true", default=False,
-                      help="only output return codes and errors")
+## Get the modification stamp of a file
+#  @param name of file
+#  @return tuple (mtime, size), None if the file does not exist
+def getStamp(name):
+  try:
+    info = os.stat(name)
+  except OSError:
+    return None
+  return info.st_mtime_ns, info.st_size
 
-  argv = sys.argv[1:]
-  args = parser.parse_args(argv)
-  if args.output_str:
-    args.quiet = True
+## Fingerprint the inputs that decide the version without running git: HEAD,
+#  the ref it points to, packed refs, tag refs, the index, and the stamps of
+#  the tracked files
+#  @param workTree root of the checked out files
+#  @param gitDir git directory of the repository
+#  @param commonDir directory holding the refs of the repository
+#  @return hashable fingerprint, None if the index cannot be read
+def getFingerprint(workTree, gitDir, commonDir):
+  with open(os.path.join(gitDir, "HEAD"), "rb") as file:
+    head = file.read()
+  ref = None
+  if head.startswith(b"ref:"):
+    ref = getStamp(os.path.join(commonDir, os.fsdecode(head[4:].strip())))
 
-  Template.checkInstallations(
-      git=args.git,
-      quiet=args.quiet)
+  # Adding or removing a tag updates the mtime of its folder
+  tags = []
+  for root, dirs, files in os.walk(os.path.join(commonDir, "refs", "tags")):
+    tags.append((root, getStamp(root)))
+    tags.extend((os.path.join(root, name), getStamp(os.path.join(root, name)))
+                for name in files)
 
+  # Unstaged edits do not touch the index, only the files they change
   try:
-    version = getVersion(args.git)
-  except Exception:
-    print("Exception getting version from git tags", file=sys.stderr)
-    traceback.print_exc()
-    sys.exit(1)
+    _, entries, _ = GitReader.Repository(workTree, gitDir, commonDir).readIndex()
+  except (GitReader.UnsupportedError, OSError, ValueError, struct.error):
+    return None
+  files = tuple(getStamp(os.path.join(workTree, entry[0])) for entry in entries)
+
+  return (head, ref, getStamp(os.path.join(commonDir, "packed-refs")),
+          tuple(sorted(tags)), getStamp(os.path.join(gitDir, "index")), files)
 
-  data = f"""#ifndef _COMMON_VERSION_H_
+## Render the version header
+#  @param version Template.Version object
+#  @return header file content
+def getHeader(version):
+  return f"""#ifndef _COMMON_VERSION_H_
 #define _COMMON_VERSION_H_
 
 #ifndef VERSION_DEFINES
@@ -95,24 +149,178 @@ const constexpr char* VERSION_GIT_SHA     = "{version.gitSHA}";
 #endif /* _COMMON_VERSION_H_ */
 """
 
-  if args.output:
-    Template.overwriteIfChanged(args.output, data, args.quiet)
-  elif args.output_str:
-    buf = args.output_str
-
-    buf = re.sub(r"%M", f"{version.major}", buf)
-    buf = re.sub(r"%m", f"{version.minor}", buf)
-    buf = re.sub(r"%p", f"{version.patch}", buf)
-    buf = re.sub(r"%t", f"{version.tweak}", buf)
-    buf = re.sub(r"%a", f"{version.ahead}", buf)
-    if version.modified:
-      buf = re.sub(r"%~", "~", buf)
-    else:
-      buf = re.sub(r"%~", "", buf)
-    buf = re.sub(r"%s", f"{version.gitSHA}", buf)
-    print(buf)
+## Format the version
+#  @param version Template.Version object
+#  @param buf format string: %M major, %m minor, %p patch, %t tweak, %a ahead,
+#    %~ modified, %s SHA
+#  @return formatted string
+def formatVersion(version, buf):
+  buf = re.sub(r"%M", f"{version.major}", buf)
+  buf = re.sub(r"%m", f"{version.minor}", buf)
+  buf = re.sub(r"%p", f"{version.patch}", buf)
+  buf = re.sub(r"%t", f"{version.tweak}", buf)
+  buf = re.sub(r"%a", f"{version.ahead}", buf)
+  if version.modified:
+    buf = re.sub(r"%~", "~", buf)
   else:
-    print(data)
+    buf = re.sub(r"%~", "", buf)
+  buf = re.sub(r"%s", f"{version.gitSHA}", buf)
+  return buf
+
+## Render the version manifest, read back by readManifest
+#  @param version Template.Version object
+#  @param untracked true if untracked files were considered a modification
+#  @return JSON file content
+def getManifest(version, untracked=True):
+  manifest = {
+      "string": version.string,
+      "full": version.fullStr(),
+      "major": version.major,
+      "minor": version.minor,
+      "patch": version.patch,
+      "tweak": version.tweak,
+      "ahead": version.ahead,
+      "modified": version.modified,
+      "untracked": untracked,
+      "gitSHA": version.gitSHA
+  }
+  return json.dumps(manifest, indent=2) + "\n"
+
+## Read a version manifest written by --output-json
+#  @param path to manifest
+#  @return tuple (Template.Version object, true if untracked files were
+#    considered a modification)
+def readManifest(path):
+  with open(path, "r") as file:
+    manifest = json.load(file)
+  version = Template.Version(manifest["string"], manifest["ahead"],
+                             manifest["modified"], manifest["gitSHA"])
+  return version, manifest.get("untracked", True)
+
+## Render a CMake file setting the version variables
+#  @param version Template.Version object
+#  @return CMake file content
+def getCMakeInclude(version):
+  return f"""set(VERSION_STRING_FULL "{version.fullStr()}")
+set(VERSION_STRING "{version.string}")
+set(VERSION_MAJOR {version.major})
+set(VERSION_MINOR {version.minor})
+set(VERSION_PATCH {version.patch})
+set(VERSION_TWEAK "{version.tweak}")
+set(VERSION_AHEAD {version.ahead})
+set(VERSION_MODIFIED {int(version.modified)})
+set(VERSION_GIT_SHA "{version.gitSHA}")
+"""
+
+## Main function
+def main():
+  # Create an arg parser menu and grab the values from the command arguments
+  parser = argparse.ArgumentParser(description="Fetch the latest version tag "
+                                   "from git then append how far ahead the "
+                                   "current repository is. Optionally outputs "
+                                   "to version files, each output may be "
+                                   "repeated and all are written from a "
+                                   "single query of git.")
+  parser.add_argument("--git", metavar="PATH", default="git",
+                      help="path to git binary")
+  parser.add_argument("--output", metavar="PATH", action="append", default=[],
+                      help="output file to write version header, default "
+                      "stdout if no other output is given")
+  parser.add_argument("--output-str", metavar="FORMAT", action="append", default=[],
+                      help="output version to stdout using the format: %%M major, %%m minor, %%p patch, %%t tweak, %%a ahead, %%~ modified, %%s SHA")
+  parser.add_argument("--output-json", metavar="PATH", action="append", default=[],
+                      help="output file to write version manifest, read by "
+                      "other tools instead of querying git again")
+  parser.add_argument("--output-cmake", metavar="PATH", action="append", default=[],
+                      help="output file to write CMake version variables, "
+                      "VERSION_MAJOR etc., for include()")
+  parser.add_argument("--quiet", action="store_true", default=False,
+                      help="only output return codes and errors")
+  parser.add_argument("--no-untracked", action="store_true", default=False,
+                      help="do not consider untracked files a modification, "
+                      "skips scanning the worktree for them")
+  parser.add_argument("--abbrev", metavar="N", type=int, default=None,
+                      help="number of hexadecimal digits of the SHA, default "
+                      "is git's")
+  parser.add_argument("--read-git", action="store_true", default=False,
+                      help="read the git directory instead of running git, "
+                      "falls back to git for unsupported layouts such as "
+                      "packed objects")
+  parser.add_argument("--memo", action="store_true", default=False,
+                      help="skip git when the repository's HEAD, refs, index, "
+                      "and tracked files are unchanged since the last run, "
+                      "requires --no-untracked")
+  parser.add_argument("--refresh-probes", action="store_true", default=False,
+                      help="probe each binary even if a previous result is cached")
+
+  argv = sys.argv[1:]
+  args = parser.parse_args(argv)
+  if args.output_str:
+    args.quiet = True
+  if args.memo and not args.no_untracked:
+    # Untracked files are not fingerprinted, finding them needs a scan
+    parser.error("--memo requires --no-untracked")
+
+  # Each output file and the function rendering its content
+  outputs = [(path, getHeader) for path in args.output]
+  outputs += [(path, lambda version: getManifest(version,
+                                                 not args.no_untracked))
+              for path in args.output_json]
+  outputs += [(path, getCMakeInclude) for path in args.output_cmake]
+
+  version = None
+  memo = None
+  if args.memo:
+    directories = GitReader.getGitDirectories(os.getcwd())
+    if directories:
+      memo = Template.Cache(os.path.join(directories[1],
+                                         "CreateVersionFromGitTag.memo")).open()
+      # Results of a different reader are not reused
+      memoKey = (args.abbrev, getStamp(os.path.abspath(__file__)),
+                 getStamp(os.path.abspath(GitReader.__file__)))
+      cached = memo.get(memoKey)
+      fingerprint = getFingerprint(*directories)
+      if cached and fingerprint is not None and cached[0] == fingerprint:
+        version, stamps = cached[1], cached[2]
+        if outputs and not args.output_str and all(
+            stamps.get(os.path.abspath(path)) == getStamp(path)
+            for path, _ in outputs):
+          if not args.quiet:
+            print("Repository unchanged:",
+                  ", ".join(path for path, _ in outputs))
+          return
+
+  if version is None:
+    Template.checkInstallations(
+        git=args.git,
+        quiet=args.quiet,
+        refresh=args.refresh_probes)
+
+    try:
+      version = getVersion(args.git, not args.no_untracked, args.abbrev,
+                           args.read_git)
+    except Exception:
+      print("Exception getting version from git tags", file=sys.stderr)
+      traceback.print_exc()
+      sys.exit(1)
+
+  for path, render in outputs:
+    Template.overwriteIfChanged(path, render(version), args.quiet)
+  for buf in args.output_str:
+    print(formatVersion(version, buf))
+  if not outputs and not args.output_str:
+    print(getHeader(version))
+
+  # git may refresh the index whilst running, fingerprint afterwards
+  fingerprint = getFingerprint(*directories) if memo else None
+  if fingerprint is not None:
+    stamps = {os.path.abspath(path): getStamp(path) for path, _ in outputs}
+    memo.set(memoKey, (fingerprint, version, stamps))
+    try:
+      memo.save()
+    except OSError:
+      # The memo only speeds up later runs, carry on without it
+      pass
 
 
 if __name__ == "__main__":
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+## Parser of the diagnostics clang-tidy outputs, turning its text into records
+#  that are deduplicated across translation units and written as SARIF or
+#  compact JSON.
+
+import json
+import os
+import re
+import urllib.parse
+
+## Pattern of the first line of a diagnostic, "path:line:column: severity:
+#  message [check]"
+pattern = re.compile(r"^(.+?):(\d+):(\d+): (warning|error|fatal error|note|"
+                     r"remark): (.*?)(?: \[([^\[\]]+)\])?\r?\n?$")
+
+## Class to hold a diagnostic and its notes
+class Diagnostic:
+  ## Initialize a diagnostic
+  #  @param self object pointer
+  #  @param path of the file the diagnostic is in
+  #  @param line number, starting at 1
+  #  @param column number, starting at 1
+  #  @param severity "warning", "error", "fatal error", "note" or "remark"
+  #  @param message of the diagnostic
+  #  @param check name, i.e. "readability-braces-around-statements", None if
+  #    the diagnostic is not from a check
+  #  @param directory relative paths are relative to, the compile command's
+  #    directory, None for the current directory
+  def __init__(self, path, line, column, severity, message, check=None,
+               directory=None):
+    self.path = path
+    self.directory = directory
+    self.line = line
+    self.column = column
+    self.severity = severity
+    self.message = message
+    self.check = check
+    self.notes = []
+    self.lines = []
+    self.translationUnits = []
+    self.duplicate = False
+
+  ## Get the absolute path of the file the diagnostic is in
+  #  @param self object pointer
+  #  @return normalized absolute path
+  def getAbsolutePath(self):
+    return os.path.normpath(os.path.join(self.directory or os.getcwd(),
+                                         self.path))
+
+  ## Get the key identifying a diagnostic, equal for the same diagnostic
+  #  reported by different translation units
+  #  @param self object pointer
+  #  @return tuple
+  def getKey(self):
+    return (self.getAbsolutePath(), self.line, self.column, self.severity,
+            self.message, self.check)
+
+  ## Get the diagnostic as a JSON serializable dictionary
+  #  @param self object pointer
+  #  @return dictionary
+  def toJson(self):
+    data = {"file": self.path, "line": self.line, "column": self.column,
+            "severity": self.severity, "message": self.message}
+    if self.check:
+      data["check"] = self.check
+    if self.notes:
+      data["notes"] = [{"file": note.path, "line": note.line,
+                        "column": note.column, "message": note.message}
+                       for note in self.notes]
+    if self.translationUnits:
+      data["translationUnits"] = sorted(self.translationUnits)
+    return data
+
+## Class to parse the output of clang-tidy line by line, as it arrives
+class Parser:
+  ## Initialize a parser
+  #  @param self object pointer
+  #  @param directory relative paths are relative to, the compile command's
+  #    directory, None for the current directory
+  def __init__(self, directory=None):
+    self.directory = directory
+    self.diagnostics = []
+    self.current = None
+
+  ## Parse a line of output
+  #  @param self object pointer
+  #  @param line of output
+  #  @return tuple (Diagnostic the line belongs to, None if before any, true if
+  #    the line starts the diagnostic)
+  def feed(self, line):
+    matches = pattern.match(line)
+    if not matches:
+      # Source snippets and carets belong to the diagnostic above
+      if self.current is not None:
+        self.current.lines.append(line)
+      return self.current, False
+    check = matches[6].split(",")[0] if matches[6] else None
+    diagnostic = Diagnostic(matches[1], int(matches[2]), int(matches[3]),
+                            matches[4], matches[5], check, self.directory)
+    if diagnostic.severity == "note" and self.current is not None:
+      self.current.notes.append(diagnostic)
+      self.current.lines.append(line)
+      return self.current, False
+    diagnostic.lines.append(line)
+    self.current = diagnostic
+    self.diagnostics.append(diagnostic)
+    return diagnostic, True
+
+## Parse the output of clang-tidy
+#  @param text output
+#  @param directory relative paths are relative to, the compile command's
+#    directory, None for the current directory
+#  @return list of Diagnostic
+def parse(text, directory=None):
+  parser = Parser(directory)
+  for line in text.splitlines(True):
+    parser.feed(line)
+  return parser.diagnostics
+
+## Class to collect the diagnostics of many translation units, a diagnostic
+#  reported by several, i.e. in a header they all include, is kept once
+class DiagnosticSet:
+  ## Initialize a set of diagnostics
+  #  @param self object pointer
+  def __init__(self):
+    self.diagnostics = {}
+
+  ## Add a diagnostic, marking it a duplicate if already added
+  #  @param self object pointer
+  #  @param diagnostic to add
+  #  @param translationUnit reporting the diagnostic
+  #  @return true if the diagnostic is new
+  def add(self, diagnostic, translationUnit):
+    key = diagnostic.getKey()
+    first = self.diagnostics.setdefault(key, diagnostic)
+    if translationUnit not in first.translationUnits:
+      first.translationUnits.append(translationUnit)
+    diagnostic.duplicate = first is not diagnostic
+    return not diagnostic.duplicate
+
+  ## Get the diagnostics, sorted by location
+  #  @param self object pointer
+  #  @return list of Diagnostic
+  def getDiagnostics(self):
+    return sorted(self.diagnostics.values(),
+                  key=lambda diagnostic: (diagnostic.path, diagnostic.line,
+                                          diagnostic.column))
+
+  ## Write the diagnostics as compact JSON
+  #  @param self object pointer
+  #  @param path to write to
+  def writeJson(self, path):
+    data = {"diagnostics": [diagnostic.toJson()
+                            for diagnostic in self.getDiagnostics()]}
+    with open(path, "w", newline="\n") as file:
+      json.dump(data, file, separators=(",", ":"))
+      file.write("\n")
+
+  ## Write the diagnostics as a SARIF 2.1.0 log
+  #  @param self object pointer
+  #  @param path to write to
+  #  @param toolVersion string of clang-tidy's version
+  #  @param root directory of the repository, paths inside are relative to it
+  def writeSarif(self, path, toolVersion, root):
+    root = os.path.join(os.path.abspath(root), "")
+    rules = {}
+    results = []
+    for diagnostic in self.getDiagnostics():
+      ruleId = diagnostic.check or "clang-diagnostic"
+      rules.setdefault(ruleId, {"id": ruleId})
+      result = {"ruleId": ruleId,
+                "level": getSarifLevel(diagnostic.severity),
+                "message": {"text": diagnostic.message},
+                "locations": [getSarifLocation(diagnostic, root)]}
+      if diagnostic.notes:
+        result["relatedLocations"] = [
+            dict(getSarifLocation(note, root), id=i,
+                 message={"text": note.message})
+            for i, note in enumerate(diagnostic.notes)]
+      if diagnostic.translationUnits:
+        result["properties"] = {
+            "translationUnits": sorted(diagnostic.translationUnits)}
+      results.append(result)
+
+    driver = {"name": "clang-tidy",
+              "informationUri": "https://clang.llvm.org/extra/clang-tidy/",
+              "rules": [rules[ruleId] for ruleId in sorted(rules)]}
+    matches = re.search(r"version (\d+(\.\d+)*)", toolVersion)
+    if matches:
+      driver["version"] = matches[1]
+    data = {"$schema": "https://json.schemastore.org/sarif-2.1.0.json",
+            "version": "2.1.0",
+            "runs": [{"tool": {"driver": driver},
+                      "originalUriBaseIds": {
+                          "SRCROOT": {"uri": toFileUri(root)}},
+                      "results": results}]}
+    with open(path, "w", newline="\n") as file:
+      json.dump(data, file, indent=2)
+      file.write("\n")
+
+## Get the SARIF level of a severity
+#  @param severity of a diagnostic
+#  @return "error", "warning" or "note"
+def getSarifLevel(severity):
+  if severity in ["error", "fatal error"]:
+    return "error"
+  if severity == "warning":
+    return "warning"
+  return "note"
+
+## Get the SARIF location of a diagnostic
+#  @param diagnostic to locate
+#  @param root directory of the repository ending with a separator, paths
+#    inside are relative to it
+#  @return dictionary
+def getSarifLocation(diagnostic, root):
+  path = diagnostic.getAbsolutePath()
+  if path.startswith(root):
+    artifact = {"uri": urllib.parse.quote(path[len(root):].replace(os.sep, "/")),
+                "uriBaseId": "SRCROOT"}
+  else:
+    artifact = {"uri": toFileUri(path)}
+  return {"physicalLocation": {
+      "artifactLocation": artifact,
+      "region": {"startLine": diagnostic.line,
+                 "startColumn": diagnostic.column}}}
+
+## Convert an absolute path to a file URI
+#  @param path absolute path
+#  @return URI string, directories keep their trailing slash
+def toFileUri(path):
+  uri = path.replace(os.sep, "/")
+  if not uri.startswith("/"):
+    # Windows drive letters
+    uri = "/" + uri
+  return "file://" + urllib.parse.quote(uri, safe="/:")
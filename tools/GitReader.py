@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+## Reader of git repository metadata that does not run git. Reads HEAD, loose
+#  and packed refs, and loose objects. Objects only stored in packfiles are
+#  read through a Template.GitObjects if given. Anything else it does not
+#  handle raises UnsupportedError so callers can fall back to the git CLI.
+
+import Template
+
+import heapq
+import itertools
+import os
+import re
+import stat
+import struct
+import zlib
+
+## Raised when the repository layout is not supported by the reader
+class UnsupportedError(Exception):
+  pass
+
+## Find the directories of the repository containing a directory, checks
+#  parent folders until root
+#  @param directory to start searching from
+#  @return tuple (worktree, git directory, common directory holding the refs
+#    and objects), None if not in a repository
+def getGitDirectories(directory):
+  directory = os.path.abspath(directory)
+  while not os.path.exists(os.path.join(directory, ".git")):
+    parent = os.path.dirname(directory)
+    if parent == directory:
+      return None
+    directory = parent
+  gitDir = os.path.join(directory, ".git")
+
+  # Worktrees and submodules have a file pointing to the git directory
+  if os.path.isfile(gitDir):
+    with open(gitDir, "r") as file:
+      line = file.read().strip()
+    if not line.startswith("gitdir:"):
+      return None
+    gitDir = Template.makeAbsolute(line[len("gitdir:"):].strip(), directory)
+  commonDir = gitDir
+  commonFile = os.path.join(gitDir, "commondir")
+  if os.path.isfile(commonFile):
+    with open(commonFile, "r") as file:
+      commonDir = Template.makeAbsolute(file.read().strip(), gitDir)
+  return directory, gitDir, commonDir
+
+## Class to read a repository's metadata
+class Repository:
+  ## Maximum number of tagged commits considered by describe, same as git's
+  maxCandidates = 10
+
+  ## Initialize a repository reader
+  #  @param self object pointer
+  #  @param workTree root of the checked out files
+  #  @param gitDir git directory of the worktree
+  #  @param commonDir directory holding the refs and objects
+  #  @param objects Template.GitObjects to read packed objects with, None
+  #    raises UnsupportedError on packed objects
+  def __init__(self, workTree, gitDir, commonDir, objects=None):
+    self.workTree = workTree
+    self.gitDir = gitDir
+    self.commonDir = commonDir
+    self.objects = objects
+    self.packedRefs = None
+    self.commits = None
+
+  ## Open the repository, checking its layout is supported
+  #  @param self object pointer
+  #  @return self
+  def open(self):
+    config = os.path.join(self.commonDir, "config")
+    if os.path.isfile(config):
+      with open(config, "r") as file:
+        text = file.read().lower()
+      # SHA-256 objects and reftable refs are laid out differently
+      if re.search(r"^\s*(objectformat|refstorage)\s*=", text, flags=re.M):
+        raise UnsupportedError("repository extensions are not supported")
+    if os.path.exists(os.path.join(self.commonDir, "shallow")):
+      raise UnsupportedError("shallow repositories are not supported")
+
+    # Commits never change, their parents are saved between runs
+    self.commits = Template.Cache(
+        os.path.join(self.commonDir, "GitReader.commits")).open()
+    return self
+
+  ## Save the commits read so later runs do not decompress them again
+  #  @param self object pointer
+  def save(self):
+    if self.commits.modified:
+      try:
+        self.commits.save()
+      except OSError:
+        # The cache only speeds up later runs, carry on without it
+        pass
+
+  ## Read an object
+  #  @param self object pointer
+  #  @param sha hexadecimal name of object
+  #  @return tuple (type, bytes of content)
+  def readObject(self, sha):
+    return self.readObjects([sha])[sha]
+
+  ## Read objects, loose objects are read directly and the others are
+  #  requested together from objects
+  #  @param self object pointer
+  #  @param shas list of hexadecimal names of objects
+  #  @return dictionary {sha: (type, bytes of content)}
+  def readObjects(self, shas):
+    results = {}
+    packed = []
+    for sha in shas:
+      path = os.path.join(self.commonDir, "objects", sha[:2], sha[2:])
+      try:
+        with open(path, "rb") as file:
+          data = zlib.decompress(file.read())
+      except FileNotFoundError:
+        packed.append(sha)
+        continue
+      header, _, content = data.partition(b"\0")
+      results[sha] = (header.split(b" ")[0].decode(), content)
+    if packed and self.objects is None:
+      raise UnsupportedError(f"object {packed[0]} is not a loose object")
+    if packed:
+      for sha, result in self.objects.read(packed).items():
+        if result is None:
+          raise UnsupportedError(f"object {sha} does not exist")
+        results[sha] = result
+    return results
+
+  ## Get the refs saved in packed-refs
+  #  @param self object pointer
+  #  @return dictionary {name: (sha, peeled sha or None if unknown)}, the peeled
+  #    sha is sha itself if it does not point to a tag object
+  def getPackedRefs(self):
+    if self.packedRefs is not None:
+      return self.packedRefs
+    self.packedRefs = {}
+    path = os.path.join(self.commonDir, "packed-refs")
+    if not os.path.isfile(path):
+      return self.packedRefs
+    name = None
+    traits = []
+    with open(path, "r") as file:
+      for line in file:
+        line = line.rstrip("\n")
+        if line.startswith("# pack-refs with:"):
+          traits = line[len("# pack-refs with:"):].split()
+          continue
+        if not line or line.startswith("#"):
+          continue
+        if line.startswith("^"):
+          self.packedRefs[name] = (self.packedRefs[name][0], line[1:])
+          continue
+        sha, name = line.split(" ", 1)
+        # Traits tell which refs would have a peeled line if they were tags
+        peeled = "fully-peeled" in traits or \
+            ("peeled" in traits and name.startswith("refs/tags/"))
+        self.packedRefs[name] = (sha, sha if peeled else None)
+    return self.packedRefs
+
+  ## Resolve a ref to the object it points to, following symbolic refs
+  #  @param self object pointer
+  #  @param name of ref, i.e. "HEAD" or "refs/heads/master"
+  #  @return sha of object
+  def readRef(self, name):
+    for _ in range(10):
+      # HEAD is per worktree, other refs are shared
+      directory = self.gitDir if name == "HEAD" else self.commonDir
+      path = os.path.join(directory, name)
+      if os.path.isfile(path):
+        with open(path, "r") as file:
+          content = file.read().strip()
+        if not content.startswith("ref:"):
+          return content
+        name = content[len("ref:"):].strip()
+      elif name in self.getPackedRefs():
+        return self.getPackedRefs()[name][0]
+      else:
+        raise UnsupportedError(f"ref {name} does not exist")
+    raise UnsupportedError("symbolic refs are nested too deeply")
+
+  ## Get the tags of the repository and the commits they point to
+  #  @param self object pointer
+  #  @return dictionary {commit sha: list of (sha of tag object or None if
+  #    lightweight, name)}
+  def getTags(self):
+    refs = {}
+    for name, (sha, peeled) in self.getPackedRefs().items():
+      if name.startswith("refs/tags/"):
+        refs[name] = (sha, peeled)
+    tagsDir = os.path.join(self.commonDir, "refs", "tags")
+    for root, _, files in os.walk(tagsDir):
+      for filename in files:
+        path = os.path.join(root, filename)
+        name = "refs/tags/" + os.path.relpath(path, tagsDir).replace(os.sep, "/")
+        with open(path, "r") as file:
+          refs[name] = (file.read().strip(), None)
+
+    tags = {}
+    for name in sorted(refs):
+      sha, peeled = refs[name]
+      tagObject = sha if peeled not in [None, sha] else None
+      while peeled is None:
+        objectType, content = self.readObject(sha)
+        if objectType != "tag":
+          peeled = sha
+          break
+        tagObject = tagObject or sha
+        sha = re.match(rb"object ([0-9a-f]+)", content)[1].decode()
+      tags.setdefault(peeled, []).append((tagObject, name[len("refs/tags/"):]))
+    return tags
+
+  ## Choose the name of a tagged commit like git, annotated tags are preferred
+  #  over lightweight ones, then the newest annotated tag, then the first name
+  #  @param self object pointer
+  #  @param tags list of (sha of tag object or None, name) of the commit
+  #  @return name of tag
+  def getTagName(self, tags):
+    annotated = [tag for tag in tags if tag[0] is not None]
+    if not annotated:
+      return tags[0][1]
+    if len(annotated) == 1:
+      return annotated[0][1]
+    objects = self.readObjects([tag[0] for tag in annotated])
+    ## Get the time a tag was created
+    #  @param tag tuple (sha of tag object, name)
+    #  @return tagger time
+    def getTime(tag):
+      content = objects[tag[0]][1].decode(errors="replace")
+      matches = re.search(r"^tagger .* (\d+) [-+]\d+$", content, flags=re.M)
+      return int(matches[1]) if matches else 0
+    return max(annotated, key=getTime)[1]
+
+  ## Get the committer time and parents of a commit
+  #  @param self object pointer
+  #  @param sha of commit
+  #  @return tuple (committer time, tuple of parent shas)
+  def getCommit(self, sha):
+    commit = self.commits.get(sha)
+    if commit is None:
+      objectType, content = self.readObject(sha)
+      if objectType != "commit":
+        raise UnsupportedError(f"object {sha} is not a commit")
+      header = content.split(b"\n\n", 1)[0].decode(errors="replace")
+      parents = tuple(re.findall(r"^parent ([0-9a-f]+)$", header, flags=re.M))
+      time = int(re.search(r"^committer .* (\d+) [-+]\d+$", header,
+                           flags=re.M)[1])
+      commit = (time, parents)
+      self.commits.set(sha, commit)
+    return commit
+
+  ## Get the commits reachable from a commit
+  #  @param self object pointer
+  #  @param sha of commit to start from
+  #  @param stop set of commits to not walk past
+  #  @return set of shas, including sha
+  def getAncestors(self, sha, stop=frozenset()):
+    ancestors = set()
+    pending = [sha]
+    while pending:
+      sha = pending.pop()
+      if sha in ancestors or sha in stop:
+        continue
+      ancestors.add(sha)
+      pending.extend(self.getCommit(sha)[1])
+    return ancestors
+
+  ## Find the most recent tag reachable from HEAD, like git describe --tags.
+  #  Follows git's walk, which visits commits newest first and counts the
+  #  commits not reachable from each candidate tag as they are visited
+  #  @param self object pointer
+  #  @return tuple (tag name, commits since tag, sha of HEAD)
+  def describe(self):
+    head = self.readRef("HEAD")
+    tags = self.getTags()
+    if head in tags:
+      return self.getTagName(tags[head]), 0, head
+
+    # Commits visited have the seen flag, and the flag of each candidate they
+    # are reachable from
+    seen = 1
+    flags = {head: seen}
+    queue = []
+    order = itertools.count()
+    ## Add a commit to the queue, newest first then first in first out
+    #  @param sha of commit
+    def push(sha):
+      heapq.heappush(queue, (-self.getCommit(sha)[0], next(order), sha))
+    push(head)
+
+    # Candidates are lists [sha, depth, flag, order found]
+    candidates = []
+    annotated = 0
+    visited = 0
+    gaveUpOn = None
+    while queue:
+      sha = heapq.heappop(queue)[2]
+      visited += 1
+      if sha in tags:
+        if len(candidates) == self.maxCandidates:
+          gaveUpOn = sha
+          break
+        flag = seen << (len(candidates) + 1)
+        candidates.append([sha, visited - 1, flag, len(candidates)])
+        flags[sha] |= flag
+        if any(tag[0] is not None for tag in tags[sha]):
+          annotated += 1
+      for candidate in candidates:
+        if not flags[sha] & candidate[2]:
+          candidate[1] += 1
+      if annotated and not queue:
+        # Stop once the last path is covered by every candidate of the least
+        # depth
+        depth = min(candidate[1] for candidate in candidates)
+        within = 0
+        for candidate in candidates:
+          if candidate[1] == depth:
+            within |= candidate[2]
+        if (flags[sha] & within) == within:
+          break
+      for parent in self.getCommit(sha)[1]:
+        if not flags.get(parent, 0) & seen:
+          push(parent)
+        flags[parent] = flags.get(parent, 0) | flags[sha]
+    if not candidates:
+      raise UnsupportedError("no tags can describe HEAD")
+
+    best = sorted(candidates, key=lambda candidate: (candidate[1],
+                                                     candidate[3]))[0]
+    if gaveUpOn:
+      push(gaveUpOn)
+
+    # Count the remaining commits not reachable from the best candidate, until
+    # all commits left are reachable from it
+    while queue:
+      sha = heapq.heappop(queue)[2]
+      if flags[sha] & best[2]:
+        if all(flags[item[2]] & best[2] for item in queue):
+          break
+      else:
+        best[1] += 1
+      for parent in self.getCommit(sha)[1]:
+        if not flags.get(parent, 0) & seen:
+          push(parent)
+        flags[parent] = flags.get(parent, 0) | flags[sha]
+    return self.getTagName(tags[best[0]]), best[1], head
+
+  ## Get the number of hexadecimal digits git abbreviates object names to by
+  #  default, which grows with the number of objects
+  #  @param self object pointer
+  #  @return number of digits
+  def getAbbrevLength(self):
+    count = 0
+    packDir = os.path.join(self.commonDir, "objects", "pack")
+    if os.path.isdir(packDir):
+      for filename in os.listdir(packDir):
+        if not filename.endswith(".idx"):
+          continue
+        with open(os.path.join(packDir, filename), "rb") as file:
+          header = file.read(8 + 256 * 4)
+        # Version 2 indices start with a signature before the fan-out table
+        offset = 8 if header[:4] == b"\377tOc" else 0
+        count += struct.unpack(">I", header[offset + 255 * 4:offset + 256 * 4])[0]
+    length = (count.bit_length() + 1) // 2
+    return max(7, length)
+
+  ## Abbreviate an object name, lengthened until unique. Packed objects are
+  #  only considered when read through objects.
+  #  @param self object pointer
+  #  @param sha of object
+  #  @param length minimum number of digits, None for git's default
+  #  @return abbreviated sha
+  def abbreviate(self, sha, length=None):
+    if length is None:
+      length = self.getAbbrevLength()
+    packDir = os.path.join(self.commonDir, "objects", "pack")
+    if self.objects is not None and os.path.isdir(packDir) and \
+        any(name.endswith(".idx") for name in os.listdir(packDir)):
+      # Every length is requested at once, the shortest not ambiguous wins
+      names = [sha[:i] for i in range(length, len(sha))]
+      results = self.objects.getInfo(names)
+      for name in names:
+        if results[name] is not None:
+          return name
+      return sha
+    directory = os.path.join(self.commonDir, "objects", sha[:2])
+    others = [sha[:2] + name for name in os.listdir(directory)
+              if sha[:2] + name != sha] if os.path.isdir(directory) else []
+    while length < len(sha) and \
+        any(other.startswith(sha[:length]) for other in others):
+      length += 1
+    return sha[:length]
+
+  ## Parse the index
+  #  @param self object pointer
+  #  @return tuple (index mtime, list of entries (path, mode, sha, mtime
+  #    seconds, mtime nanoseconds, size), sha of root tree or None if the
+  #    index has no valid cached tree)
+  def readIndex(self):
+    path = os.path.join(self.gitDir, "index")
+    with open(path, "rb") as file:
+      data = file.read()
+      mtime = os.fstat(file.fileno()).st_mtime_ns
+    signature, version, count = struct.unpack(">4sII", data[:12])
+    if signature != b"DIRC" or version not in [2, 3]:
+      raise UnsupportedError(f"index version {version} is not supported")
+
+    entries = []
+    offset = 12
+    for _ in range(count):
+      (_, _, mtimeSeconds, mtimeNanoseconds, _, _, mode, _, _, size, sha,
+       flags) = struct.unpack(">10I20sH", data[offset:offset + 62])
+      start = offset + 62
+      if flags & 0x4000:
+        # skip-worktree and intent-to-add entries do not match the worktree
+        raise UnsupportedError("extended index entries are not supported")
+      if flags & 0x3000:
+        raise UnsupportedError("index has unmerged entries")
+      end = data.index(b"\0", start)
+      name = data[start:end].decode()
+      entries.append((name, mode, sha.hex(), mtimeSeconds, mtimeNanoseconds,
+                      size))
+      # Entries are padded with NULs to a multiple of 8 bytes
+      offset += (end - offset + 8) & ~7
+
+    # The cached tree extension records the tree the index would commit.
+    # Extensions not starting with an uppercase letter, i.e. the split index
+    # "link", change the meaning of the entries and cannot be ignored.
+    rootTree = None
+    while offset + 8 <= len(data) - 20:
+      extension, length = struct.unpack(">4sI", data[offset:offset + 8])
+      if extension == b"TREE":
+        content = data[offset + 8:offset + 8 + length]
+        matches = re.match(rb"\0(-?\d+) (\d+)\n", content)
+        if matches and int(matches[1]) >= 0:
+          rootTree = content[matches.end():matches.end() + 20].hex()
+      elif not b"A"[0] <= extension[0] <= b"Z"[0]:
+        raise UnsupportedError(
+            f"index extension {extension.decode(errors='replace')} is not "
+            "supported")
+      offset += 8 + length
+    return mtime, entries, rootTree
+
+  ## Get the files of a tree
+  #  @param self object pointer
+  #  @param sha of tree
+  #  @param prefix to prepend to paths
+  #  @return dictionary {path: (mode, sha)}
+  def readTree(self, sha, prefix=""):
+    objectType, content = self.readObject(sha)
+    if objectType != "tree":
+      raise UnsupportedError(f"object {sha} is not a tree")
+    files = {}
+    offset = 0
+    while offset < len(content):
+      end = content.index(b"\0", offset)
+      mode, name = content[offset:end].split(b" ", 1)
+      child = content[end + 1:end + 21].hex()
+      offset = end + 21
+      path = prefix + name.decode()
+      mode = int(mode, 8)
+      if mode == 0o40000:
+        files.update(self.readTree(child, path + "/"))
+      else:
+        files[path] = (mode, child)
+    return files
+
+  ## Check if tracked files are modified, like git describe --dirty
+  #  @param self object pointer
+  #  @param head sha of HEAD
+  #  @return true if the index or worktree differs from HEAD
+  def isModified(self, head):
+    indexTime, entries, rootTree = self.readIndex()
+    commitTree = re.match(rb"tree ([0-9a-f]+)", self.readObject(head)[1])[1]
+    commitTree = commitTree.decode()
+
+    # Staged changes
+    if rootTree is not None:
+      if rootTree != commitTree:
+        return True
+    else:
+      files = {entry[0]: (entry[1], entry[2]) for entry in entries}
+      if files != self.readTree(commitTree):
+        return True
+
+    # Unstaged changes, only the file stamps are compared
+    for name, mode, _, mtimeSeconds, mtimeNanoseconds, size in entries:
+      if mode == 0o160000:
+        raise UnsupportedError("submodules are not supported")
+      try:
+        info = os.lstat(os.path.join(self.workTree, name))
+      except FileNotFoundError:
+        return True
+      mtime = mtimeSeconds * 1000000000 + mtimeNanoseconds
+      if mtime >= indexTime:
+        # Racily clean, the file may have changed within the same timestamp
+        raise UnsupportedError(f"{name} is racily clean")
+      if info.st_size != size or info.st_mtime_ns != mtime:
+        # The content may still be the same, git has to compare it
+        raise UnsupportedError(f"{name} stamp differs from the index")
+      if os.name != "nt" and stat.S_ISREG(info.st_mode) and \
+          bool(mode & 0o100) != bool(info.st_mode & 0o100):
+        return True
+    return False
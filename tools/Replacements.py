@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+## Engine to apply the replacements clang-tidy exports with -export-fixes,
+#  grouped by the file they change so files can be applied independently and
+#  conflicting edits are detected instead of corrupting the file.
+
+import Template
+
+import os
+import re
+import threading
+
+## Unquote a YAML scalar as written by LLVM's YAML output
+#  @param value scalar text, may span lines when quoted
+#  @return string
+def unquote(value):
+  value = value.strip()
+  if not value or value[0] not in "'\"":
+    return value
+  quote = value[0]
+  value = value[1:-1]
+  # Line breaks of quoted scalars are folded: a single break is a space, each
+  # further break (an empty line) is a newline
+  lines = value.split("\n")
+  folded = lines[0]
+  for i, line in enumerate(lines[1:], 1):
+    last = i == len(lines) - 1
+    line = line.lstrip() if last else line.strip()
+    if not line and last:
+      # The line of the closing quote, its break folds like any other
+      if folded and not folded.endswith("\n"):
+        folded += " "
+    elif not line:
+      folded += "\n"
+    elif folded and not folded.endswith("\n"):
+      folded += " " + line
+    else:
+      folded += line
+  if quote == "'":
+    return folded.replace("''", "'")
+  return folded.encode("latin-1", "backslashreplace").decode("unicode_escape")
+
+## Check if a scalar's closing quote has been read
+#  @param value scalar text read so far
+#  @return true if value is complete
+def isComplete(value):
+  value = value.strip()
+  if not value or value[0] not in "'\"":
+    return True
+  if len(value) < 2:
+    return False
+  if value[0] == "'":
+    # Quotes inside are doubled, strip the pairs before looking for the end
+    return re.sub(r"''", "", value[1:]).endswith("'")
+  return re.sub(r"\\.", "", value[1:]).endswith('"')
+
+## Parse the replacements of a file exported by clang-tidy -export-fixes
+#  @param text content of the file
+#  @return list of (absolute path, offset, length, text) tuples
+def parseFixes(text):
+  replacements = []
+  buildDirectory = os.getcwd()
+  current = None
+  lines = text.splitlines()
+  i = 0
+  while i < len(lines):
+    matches = re.match(r"^\s*(-\s+)?([A-Za-z]+):\s?(.*)$", lines[i])
+    i += 1
+    if not matches:
+      continue
+    key = matches[2]
+    value = matches[3]
+    # Quoted scalars continue on following lines until their closing quote
+    while not isComplete(value) and i < len(lines):
+      value += "\n" + lines[i]
+      i += 1
+    value = unquote(value)
+
+    if key == "BuildDirectory":
+      buildDirectory = value
+    elif key == "FilePath" and matches[1]:
+      # Replacements are list items starting with their file
+      current = {"FilePath": value}
+    elif current is not None and key in ["Offset", "Length", "ReplacementText"]:
+      current[key] = value
+      if len(current) == 4:
+        replacements.append((current["FilePath"], int(current["Offset"]),
+                             int(current["Length"]),
+                             current["ReplacementText"]))
+        current = None
+
+  # Paths are relative to the build directory if not absolute
+  return [(Template.makeAbsolute(path, buildDirectory), offset, length, text)
+          for path, offset, length, text in replacements]
+
+## Class to collect replacements and apply them file by file
+class FixSet:
+  ## Initialize a set of fixes
+  #  @param self object pointer
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.files = {}
+
+  ## Add replacements, duplicates exported by several translation units are
+  #  only applied once
+  #  @param self object pointer
+  #  @param replacements list of (absolute path, offset, length, text) tuples
+  def add(self, replacements):
+    with self.lock:
+      for path, offset, length, text in replacements:
+        self.files.setdefault(path, set()).add((offset, length, text))
+
+  ## Get the files with replacements
+  #  @param self object pointer
+  #  @return list of absolute paths
+  def getFiles(self):
+    with self.lock:
+      return list(self.files)
+
+  ## Get the replacements of a file that overlap another
+  #  @param self object pointer
+  #  @param path absolute path of file
+  #  @return list of ((offset, length, text), (offset, length, text)) pairs
+  def getConflicts(self, path):
+    with self.lock:
+      replacements = sorted(self.files.get(path, []))
+    conflicts = []
+    for i, first in enumerate(replacements):
+      end = first[0] + first[1]
+      for second in replacements[i + 1:]:
+        # Edits may touch, except two insertions at the same offset
+        if second[0] > end or \
+            (second[0] == end and (first[1] != 0 or second[1] != 0)):
+          break
+        conflicts.append((first, second))
+    return conflicts
+
+  ## Apply the replacements of a file, unless any overlap
+  #  @param self object pointer
+  #  @param path absolute path of file
+  #  @return list of conflicts from getConflicts, empty if applied
+  def apply(self, path):
+    conflicts = self.getConflicts(path)
+    if conflicts:
+      return conflicts
+    with self.lock:
+      replacements = sorted(self.files.pop(path, []))
+    if not replacements:
+      return []
+    with open(path, "rb") as file:
+      data = file.read()
+    pieces = []
+    start = 0
+    for offset, length, text in replacements:
+      pieces.append(data[start:offset])
+      pieces.append(text.encode())
+      start = offset + length
+    pieces.append(data[start:])
+    Template.overwriteIfChanged(path, b"".join(pieces), True)
+    return []
@@ -265,8 +265,6 @@ def main():
                       help="path to clang-format binary")
   parser.add_argument("--clang-tidy", metavar="PATH", default="clang-tidy",
                       help="path to clang-tidy binary")
-  parser.add_argument("--clang-apply-replacements", metavar="PATH", default="clang-apply-replacements",
-                      help="path to clang-apply-replacements binary")
   parser.add_argument("--git", metavar="PATH", default="git",
                       help="path to git binary")
   parser.add_argument("--doxygen", metavar="PATH", default="doxygen",
@@ -279,6 +277,8 @@ def main():
                       help="discard saved configuration and start from step 2")
   parser.add_argument("-s", default=None,
                       help="step to start with")
+  parser.add_argument("--refresh-probes", action="store_true", default=False,
+                      help="probe each binary even if a previous result is cached")
 
   argv = sys.argv[1:]
   args = parser.parse_args(argv)
@@ -297,11 +297,11 @@ def main():
         True,
         args.clang_format,
         args.clang_tidy,
-        args.clang_apply_replacements,
         args.doxygen,
         args.cmake,
         True,
-        False)
+        False,
+        args.refresh_probes)
     progress.increment()
     print("All software dependencies have been installed")
   else:
@@ -6,11 +6,17 @@ if sys.version_info[0] != 3 or sys.version_info[1] < 6:
   sys.exit(1)
 
 import argparse
+import atexit
+import concurrent.futures
 import os
 import pickle
 import re
+import shutil
 import subprocess
 import stat
+import tempfile
+import threading
+import time
 import traceback
 
 ## Semantic versioning object with string parsing
@@ -73,15 +79,79 @@ class Version:
       return False
     return True
 
+## Seconds a cached probe of an executable is trusted for
+probeTTL = 7 * 24 * 60 * 60
+
+## Cache of probes shared by all tools, opened on first use
+probeCache = None
+
+## Lock of probeCache, probes may run concurrently
+probeLock = threading.Lock()
+
+## Get the directory to save caches shared between repositories to
+#  @return absolute path of directory
+def getCacheDirectory():
+  if os.name == "nt":
+    base = os.environ.get("LOCALAPPDATA", tempfile.gettempdir())
+  else:
+    base = os.environ.get("XDG_CACHE_HOME",
+                          os.path.join(os.path.expanduser("~"), ".cache"))
+  return os.path.join(base, "CppProjectTemplate")
+
+## Probe an executable, caching the result until the executable changes or the
+#  result is older than probeTTL
+#  @param exe executable probed
+#  @param key hashable identifying the probe, i.e. the arguments
+#  @param func to call to probe, its return value is cached, exceptions are not
+#  @param refresh true will call func even if a result is cached
+#  @return value returned by func
+def cachedProbe(exe, key, func, refresh=False):
+  global probeCache
+  path = shutil.which(exe)
+  if not path:
+    return func()
+
+  path = os.path.realpath(path)
+  info = os.stat(path)
+  stamp = (info.st_mtime_ns, info.st_size)
+  key = (path, key)
+  with probeLock:
+    if probeCache is None:
+      probeCache = Cache(os.path.join(getCacheDirectory(), "probes.pkl")).open()
+    cached = probeCache.get(key)
+  if not refresh and cached and cached[0] == stamp and \
+      0 <= time.time() - cached[1] < probeTTL:
+    return cached[2]
+
+  result = func()
+  with probeLock:
+    probeCache.set(key, (stamp, time.time(), result))
+    try:
+      probeCache.save()
+    except OSError:
+      # The cache only speeds up later runs, carry on without it
+      pass
+  return result
+
+## Run a command that probes an executable, i.e. for its version, caching its
+#  output
+#  @param cmd command to run, i.e. ["git", "--version"]
+#  @param refresh true will run the command even if its output is cached
+#  @return stdout of the command, raises an exception if the command fails
+def probe(cmd, refresh=False):
+  return cachedProbe(cmd[0], tuple(cmd[1:]),
+                     lambda: subprocess.check_output(cmd, universal_newlines=True),
+                     refresh)
+
 ## Run a command, read its output for semantic version, compare to a minimum
 #  @param cmd command to run, i.e. ["git", "--version"]
 #  @param minimum semantic version string to compare to
+#  @param refresh true will run the command even if its output is cached
 #  @return true if outputted version is greater or equal to the minimum,
 #    false otherwise (including exception occurred whilst executing command)
-def checkSemver(cmd, minimum):
+def checkSemver(cmd, minimum, refresh=False):
   try:
-    output = subprocess.check_output(
-        cmd, universal_newlines=True)
+    output = probe(cmd, refresh)
   except BaseException:
     sys.stderr.write(
         "Unable to run {:}. Is command correctly specified?\n".format(cmd[0]))
@@ -130,22 +200,57 @@ def findInParent(file, directory):
     directory += "../"
   return makeAbsolute(file, directory)
 
-## Write data to file if file does not exist or existing content is different
+## Size of the chunks files are compared and written in
+chunkSize = 1 << 20
+
+## Check if a file's content is equal to data, reading the file in chunks
+#  @param path to compare
+#  @param data bytes to compare to
+#  @return true if the file exists and its content is data, false otherwise
+def fileEquals(path, data):
+  try:
+    if os.path.getsize(path) != len(data):
+      return False
+    view = memoryview(data)
+    with open(path, "rb") as file:
+      for start in range(0, len(data), chunkSize):
+        if file.read(chunkSize) != view[start:start + chunkSize]:
+          return False
+  except OSError:
+    return False
+  return True
+
+## Write data to file if file does not exist or existing content is different.
+#  The file is replaced atomically so readers never see a partial file, and is
+#  untouched if unchanged to keep its modification time
 #  @param path to write to
-#  @param data to write
+#  @param data to write, str is written UTF-8 encoded without newline
+#    translation, or bytes
 #  @param quiet will only print errors
+#  @return true if the file was written, false if unchanged
 def overwriteIfChanged(path, data, quiet):
-  write = True
-  if os.path.isfile(path):
-    with open(path, "r", newline="\n") as file:
-      write = file.read() != data
-      if not write and not quiet:
-        print("File unchanged:", path)
-  if write:
-    with open(path, "w", newline="\n") as file:
-      file.write(data)
-      if not quiet:
-        print("Wrote to:", path)
+  if isinstance(data, str):
+    data = data.encode()
+  if fileEquals(path, data):
+    if not quiet:
+      print("File unchanged:", path)
+    return False
+
+  tmpPath = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+  try:
+    with open(tmpPath, "wb") as file:
+      view = memoryview(data)
+      for start in range(0, len(data), chunkSize):
+        file.write(view[start:start + chunkSize])
+    if os.path.exists(path):
+      shutil.copymode(path, tmpPath)
+    os.replace(tmpPath, path)
+  finally:
+    if os.path.exists(tmpPath):
+      os.remove(tmpPath)
+  if not quiet:
+    print("Wrote to:", path)
+  return True
 
 ## Class to track the progress of a procedure between runs of the script
 class Progress:
@@ -180,88 +285,314 @@ class Progress:
     if os.path.exists(self.path):
       os.remove(self.path)
 
+## Class to store results of expensive operations between runs of a script
+class Cache:
+  ## Initialize a cache object
+  #  @param self object pointer
+  #  @param path to save cache to
+  def __init__(self, path):
+    self.path = makeAbsolute(path, os.getcwd())
+    self.entries = {}
+    self.modified = False
+
+  ## Open cache from save file, an unreadable save file is treated as empty
+  #  @param self object pointer
+  #  @return self with entries loaded from save if path exists
+  def open(self):
+    if os.path.exists(self.path):
+      try:
+        with open(self.path, "rb") as file:
+          self.entries = pickle.load(file)
+      except Exception:
+        self.entries = {}
+    return self
+
+  ## Get a cached value
+  #  @param self object pointer
+  #  @param key of entry
+  #  @param default value to return if the entry does not exist
+  #  @return cached value or default
+  def get(self, key, default=None):
+    return self.entries.get(key, default)
+
+  ## Set a cached value
+  #  @param self object pointer
+  #  @param key of entry
+  #  @param value to store
+  def set(self, key, value):
+    self.entries[key] = value
+    self.modified = True
+
+  ## Save cache to file if any entries have been set
+  #  @param self object pointer
+  def save(self):
+    if not self.modified:
+      return
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    tmpPath = "{}.{}.tmp".format(self.path, os.getpid())
+    with open(tmpPath, "wb") as file:
+      pickle.dump(self.entries, file, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpPath, self.path)
+    self.modified = False
+
+## Class to read objects of a git repository through long running git cat-file
+#  processes, one outputting content (--batch) and one outputting type and
+#  size (--batch-check). Requests are written whilst the responses are read so
+#  many objects are read without waiting on each in turn.
+class GitObjects:
+  ## Initialize a reader, processes are started by the first request
+  #  @param self object pointer
+  #  @param git executable
+  #  @param cwd directory of the repository, None for the current directory
+  def __init__(self, git="git", cwd=None):
+    self.git = git
+    self.cwd = cwd
+    self.processes = {}
+    self.lock = threading.Lock()
+
+  ## Get the process of a mode, starting it if not running
+  #  @param self object pointer
+  #  @param mode option of git cat-file, "--batch" or "--batch-check"
+  #  @return subprocess.Popen object
+  def getProcess(self, mode):
+    proc = self.processes.get(mode)
+    if proc is None or proc.poll() is not None:
+      # Ambiguous names are answered on stdout, stderr only repeats them
+      proc = subprocess.Popen([self.git, "cat-file", mode], cwd=self.cwd,
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL)
+      self.processes[mode] = proc
+    return proc
+
+  ## Write requests to a process, then flush them
+  #  @param proc subprocess.Popen object
+  #  @param names list of object names
+  @staticmethod
+  def writeRequests(proc, names):
+    try:
+      for name in names:
+        proc.stdin.write(name.encode() + b"\n")
+      proc.stdin.flush()
+    except (BrokenPipeError, ValueError):
+      # The process exited, reading its output fails and tells why
+      pass
+
+  ## Request objects, reading the responses as they are output
+  #  @param self object pointer
+  #  @param mode option of git cat-file, "--batch" or "--batch-check"
+  #  @param names list of object names, i.e. a sha, "HEAD:README.md" or
+  #    ":README.md" for the staged file
+  #  @param handle function(stdout, (sha, type, size)) called on each object
+  #    found, must read the content of --batch, returns the object's result
+  #  @return dictionary {name: result of handle, None if the object is
+  #    missing or the name is ambiguous}
+  def request(self, mode, names, handle):
+    for name in names:
+      if "\n" in name:
+        raise ValueError("object name {!r} cannot contain a newline".format(name))
+    results = {}
+    with self.lock:
+      proc = self.getProcess(mode)
+      # Writing is on a thread so neither process blocks on a full pipe
+      writer = threading.Thread(target=self.writeRequests, args=(proc, names))
+      writer.start()
+      try:
+        for name in names:
+          header = proc.stdout.readline()
+          if not header.endswith(b"\n"):
+            raise OSError("git cat-file exited reading {}".format(name))
+          # "<sha> <type> <size>", or "<name> missing" and "<name>
+          # ambiguous" where the name may contain spaces
+          header = header[:-1].decode(errors="replace")
+          if header.endswith((" missing", " ambiguous")):
+            results[name] = None
+            continue
+          fields = header.rsplit(" ", 2)
+          results[name] = handle(proc.stdout,
+                                 (fields[0], fields[1], int(fields[2])))
+      except BaseException:
+        # Responses not read would be mistaken for the next request's
+        del self.processes[mode]
+        proc.kill()
+        proc.wait()
+        raise
+      finally:
+        writer.join()
+    return results
+
+  ## Get the type and size of objects
+  #  @param self object pointer
+  #  @param names list of object names
+  #  @return dictionary {name: (sha, type, size), None if not found}
+  def getInfo(self, names):
+    return self.request("--batch-check", names, lambda stdout, info: info)
+
+  ## Read the content of objects
+  #  @param self object pointer
+  #  @param names list of object names
+  #  @return dictionary {name: (type, bytes of content), None if not found}
+  def read(self, names):
+    ## Read the content of an object and its trailing newline
+    #  @param stdout of git cat-file
+    #  @param info tuple (sha, type, size)
+    #  @return tuple (type, bytes of content)
+    def handle(stdout, info):
+      content = stdout.read(info[2] + 1)
+      if len(content) != info[2] + 1:
+        raise OSError("git cat-file exited reading {}".format(info[0]))
+      return info[1], content[:-1]
+    return self.request("--batch", names, handle)
+
+  ## Copy the content of an object to a file in chunks, without holding all of
+  #  it in memory
+  #  @param self object pointer
+  #  @param name of object
+  #  @param file object opened for binary writing
+  #  @return type of object, None if not found
+  def copy(self, name, file):
+    ## Copy the content of an object and skip its trailing newline
+    #  @param stdout of git cat-file
+    #  @param info tuple (sha, type, size)
+    #  @return type of object
+    def handle(stdout, info):
+      remaining = info[2]
+      while remaining > 0:
+        chunk = stdout.read(min(chunkSize, remaining))
+        if not chunk:
+          raise OSError("git cat-file exited reading {}".format(name))
+        file.write(chunk)
+        remaining -= len(chunk)
+      stdout.read(1)
+      return info[1]
+    return self.request("--batch", [name], handle)[name]
+
+  ## Stop the processes
+  #  @param self object pointer
+  def close(self):
+    with self.lock:
+      for proc in self.processes.values():
+        proc.stdin.close()
+        proc.wait()
+        proc.stdout.close()
+      self.processes = {}
+
+## GitObjects shared by the users of each repository, see getGitObjects
+gitObjects = {}
+gitObjectsLock = threading.Lock()
+
+## Get the GitObjects of a repository, shared so each tool runs at most one
+#  pair of git cat-file processes per repository
+#  @param git executable
+#  @param cwd directory of the repository, None for the current directory
+#  @return GitObjects object, stopped when the script exits
+def getGitObjects(git="git", cwd=None):
+  key = (git, os.path.realpath(cwd or os.getcwd()))
+  with gitObjectsLock:
+    if not gitObjects:
+      atexit.register(closeGitObjects)
+    if key not in gitObjects:
+      gitObjects[key] = GitObjects(git, key[1])
+    return gitObjects[key]
+
+## Stop the processes of every shared GitObjects
+def closeGitObjects():
+  with gitObjectsLock:
+    for objects in gitObjects.values():
+      objects.close()
+    gitObjects.clear()
+
 ## Check the required installations
 #  If an installation does not pass check, terminate program
 #  @param git executable
 #  @param gitConfig will check for user.name and user.email when true
 #  @param clangFormat executable
 #  @param clangTidy executable
-#  @param clangApplyReplacements executable
 #  @param doxygen executable
 #  @param cmake executable
 #  @param testCompiler will test for a compiler when true
 #  @param quiet will only print errors
-def checkInstallations(git=None, gitConfig=False, clangFormat=None, clangTidy=None, clangApplyReplacements=None,
-                       doxygen=None, cmake=None, testCompiler=False, quiet=False):
-  if git:
-    if not quiet:
-      print("Checking git version")
-    if not checkSemver([git, "--version"], "2.17.0"):
-      print("Install git version 2.17+", file=sys.stderr)
-      sys.exit(1)
-
-    if gitConfig:
-      if not quiet:
-        print("Checking git config")
-      try:
-        call([git, "config", "--global", "user.name"])
-        call([git, "config", "--global", "user.email"])
-      except Exception:
-        print("No identity for git", file=sys.stderr)
-        print("git config --global user.name \"Your name\"", file=sys.stderr)
-        print(
-            "git config --global user.email \"you@example.com\"",
-            file=sys.stderr)
-        sys.exit(1)
+#  @param refresh will probe each executable even if a result is cached
+def checkInstallations(git=None, gitConfig=False, clangFormat=None, clangTidy=None,
+                       doxygen=None, cmake=None, testCompiler=False, quiet=False,
+                       refresh=False):
+  ## Check the version of an executable
+  #  @param exe executable
+  #  @param minimum semantic version string to compare to
+  #  @param message to report if the version is too old
+  #  @return list of error messages, empty if the check passed
+  def checkVersion(exe, minimum, message):
+    if checkSemver([exe, "--version"], minimum, refresh):
+      return []
+    return [message]
 
-  if clangFormat:
-    if not quiet:
-      print("Checking clang-format version")
-    if not checkSemver([clangFormat, "--version"], "7.0.0"):
-      print("Install clang-format version 7.0+", file=sys.stderr)
-      sys.exit(1)
+  ## Check git has an identity configured
+  #  @return list of error messages, empty if the check passed
+  def checkGitConfig():
+    try:
+      call([git, "config", "--global", "user.name"])
+      call([git, "config", "--global", "user.email"])
+    except Exception:
+      return ["No identity for git",
+              "git config --global user.name \"Your name\"",
+              "git config --global user.email \"you@example.com\""]
+    return []
 
-  if clangTidy:
-    if not quiet:
-      print("Checking clang-tidy version")
-    if not checkSemver([clangTidy, "--version"], "7.0.0"):
-      print("Install clang-tidy version 7.0+", file=sys.stderr)
-      sys.exit(1)
+  ## Configure an empty project to find a compiler
+  #  @return true
+  def testConfigure():
+    call([cmake, "-E", "make_directory", "__temp__"])
+    call([cmake, "-E", "touch", "CMakeLists.txt"], "__temp__")
+    call([cmake, "--check-system-vars", "-Wno-dev", "."], "__temp__")
+    call([cmake, "-E", "remove_directory", "__temp__"])
+    return True
 
-  if clangApplyReplacements:
-    if not quiet:
-      print("Checking clang-apply-replacements version")
-    if not checkSemver([clangApplyReplacements, "--version"], "7.0.0"):
-      print("Install clang-apply-replacements version 7.0+", file=sys.stderr)
-      sys.exit(1)
+  ## Check a compiler is found
+  #  @return list of error messages, empty if the check passed
+  def checkCompiler():
+    try:
+      # The compiler found depends on the environment
+      environment = tuple(os.environ.get(name)
+                          for name in ["CC", "CXX", "PATH"])
+      cachedProbe(cmake, ("compiler", environment), testConfigure, refresh)
+    except Exception:
+      return ["Failed to check for a compiler", traceback.format_exc().strip()]
+    return []
 
+  checks = []
+  if git:
+    checks.append(("git version", checkVersion,
+                   (git, "2.17.0", "Install git version 2.17+")))
+    if gitConfig:
+      checks.append(("git config", checkGitConfig, ()))
+  if clangFormat:
+    checks.append(("clang-format version", checkVersion,
+                   (clangFormat, "7.0.0", "Install clang-format version 7.0+")))
+  if clangTidy:
+    checks.append(("clang-tidy version", checkVersion,
+                   (clangTidy, "7.0.0", "Install clang-tidy version 7.0+")))
   if doxygen:
-    if not quiet:
-      print("Checking doxygen version")
-    if not checkSemver([doxygen, "--version"], "1.8.17"):
-      print("Install doxygen version 1.8.17+", file=sys.stderr)
-      sys.exit(1)
-
+    checks.append(("doxygen version", checkVersion,
+                   (doxygen, "1.8.17", "Install doxygen version 1.8.17+")))
   if cmake:
-    if not quiet:
-      print("Checking cmake version")
-    if not checkSemver([cmake, "--version"], "3.13.0"):
-      print("Install cmake version 3.13+", file=sys.stderr)
-      sys.exit(1)
-
+    checks.append(("cmake version", checkVersion,
+                   (cmake, "3.13.0", "Install cmake version 3.13+")))
     if testCompiler:
+      checks.append(("working compiler exists", checkCompiler, ()))
+
+  # Probes spend their time waiting on subprocesses, run them all at once and
+  # report every failure together
+  with concurrent.futures.ThreadPoolExecutor(max(1, len(checks))) as executor:
+    futures = []
+    for name, func, funcArgs in checks:
       if not quiet:
-        print("Checking working compiler exists")
-      try:
-        call([cmake, "-E", "make_directory", "__temp__"])
-        call([cmake, "-E", "touch", "CMakeLists.txt"], "__temp__")
-        call([cmake, "--check-system-vars", "-Wno-dev", "."], "__temp__")
-        call([cmake, "-E", "remove_directory", "__temp__"])
-      except Exception:
-        print("Failed to check for a compiler", file=sys.stderr)
-        traceback.print_exc()
-        sys.exit(1)
+        print("Checking", name)
+      futures.append(executor.submit(func, *funcArgs))
+    errors = [message for future in futures for message in future.result()]
 
+  if errors:
+    for message in errors:
+      print(message, file=sys.stderr)
+    sys.exit(1)
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(
@@ -272,12 +603,12 @@ if __name__ == "__main__":
                       help="path to clang-format binary")
   parser.add_argument("--clang-tidy", metavar="PATH", default="clang-tidy",
                       help="path to clang-tidy binary")
-  parser.add_argument("--clang-apply-replacements", metavar="PATH", default="clang-apply-replacements",
-                      help="path to clang-apply-replacements binary")
   parser.add_argument("--git", metavar="PATH", default="git",
                       help="path to git binary")
   parser.add_argument("--doxygen", metavar="PATH", default="doxygen",
                       help="path to doxygen binary")
+  parser.add_argument("--refresh-probes", action="store_true", default=False,
+                      help="probe each binary even if a previous result is cached")
 
   argv = sys.argv[1:]
   args = parser.parse_args(argv)
@@ -287,9 +618,9 @@ if __name__ == "__main__":
       True,
       args.clang_format,
       args.clang_tidy,
-      args.clang_apply_replacements,
       args.doxygen,
       args.cmake,
       True,
-      False)
+      False,
+      args.refresh_probes)
   print("All software dependencies have been installed")
@@ -5,8 +5,13 @@ import Template
 import CreateVersionFromGitTag as VersionTag
 
 import argparse
+import concurrent.futures
+import fnmatch
+import hashlib
+import multiprocessing
 import os
 import re
+import shlex
 import shutil
 import subprocess
 import sys
@@ -31,6 +36,322 @@ def checkCurrentBranchStatus(git, quiet, version):
 
   return status
 
+## Read a doxygen configuration file, following @INCLUDE
+#  @param path to configuration file
+#  @param config dictionary to add to, default is a new dictionary
+#  @return dictionary {tag: list of values}, tag "@INCLUDE" lists the files read
+def readDoxyfile(path, config=None):
+  if config is None:
+    config = {"@INCLUDE": []}
+  config["@INCLUDE"].append(path)
+  with open(path, "r") as file:
+    text = re.sub(r"\\\n", " ", file.read())
+  for line in text.splitlines():
+    matches = re.match(r"^\s*(@INCLUDE|[A-Z_0-9]+)\s*(\+?=)?\s*(.*)$", line)
+    if not matches or (matches[1] != "@INCLUDE" and not matches[2]):
+      continue
+    values = shlex.split(matches[3])
+    if matches[1] == "@INCLUDE":
+      for include in values:
+        readDoxyfile(include, config)
+    elif matches[2] == "+=":
+      config.setdefault(matches[1], []).extend(values)
+    else:
+      config[matches[1]] = values
+  return config
+
+## Get a single value of a doxygen configuration
+#  @param config dictionary from readDoxyfile
+#  @param tag to get
+#  @param default value if the tag is not set
+#  @return value of tag
+def getDoxyValue(config, tag, default=""):
+  values = config.get(tag)
+  return values[0] if values else default
+
+## Get the source files doxygen reads for a configuration
+#  @param config dictionary from readDoxyfile
+#  @return sorted list of relative file paths
+def getInputFiles(config):
+  patterns = config.get("FILE_PATTERNS") or ["*"]
+  excludes = {os.path.normpath(path) for path in config.get("EXCLUDE", [])}
+  excludes.add(os.path.normpath(getDoxyValue(config, "OUTPUT_DIRECTORY", ".")))
+  excludePatterns = config.get("EXCLUDE_PATTERNS", [])
+  recursive = getDoxyValue(config, "RECURSIVE", "NO") == "YES"
+
+  ## Check if a path is excluded
+  #  @param path relative path
+  #  @return true if doxygen skips path
+  def excluded(path):
+    path = os.path.normpath(path)
+    return path in excludes or any(
+        fnmatch.fnmatch(os.path.abspath(path), pattern)
+        for pattern in excludePatterns)
+
+  files = set()
+  for inputPath in config.get("INPUT") or ["."]:
+    if os.path.isfile(inputPath):
+      files.add(os.path.normpath(inputPath))
+      continue
+    for root, dirs, filenames in os.walk(inputPath):
+      dirs[:] = [directory for directory in dirs
+                 if recursive and not directory.startswith(".") and
+                 not excluded(os.path.join(root, directory))]
+      for filename in filenames:
+        path = os.path.join(root, filename)
+        if any(fnmatch.fnmatch(filename, pattern) for pattern in patterns) \
+            and not excluded(path):
+          files.add(os.path.normpath(path))
+  return sorted(files)
+
+## Get the other files a doxygen configuration reads: templates, images, and
+#  the configuration files
+#  @param config dictionary from readDoxyfile
+#  @return sorted list of relative file paths
+def getSupportFiles(config):
+  files = set(config["@INCLUDE"])
+  for tag in ["PROJECT_LOGO", "LAYOUT_FILE", "HTML_HEADER", "HTML_FOOTER",
+              "HTML_EXTRA_STYLESHEET", "HTML_EXTRA_FILES", "TAGFILES"]:
+    for value in config.get(tag, []):
+      # Tag files may be given as file=location
+      path = value.split("=")[0]
+      if os.path.isfile(path):
+        files.add(os.path.normpath(path))
+  for directory in config.get("IMAGE_PATH", []) + config.get("EXAMPLE_PATH", []):
+    for root, _, filenames in os.walk(directory):
+      files.update(os.path.normpath(os.path.join(root, filename))
+                   for filename in filenames)
+  return sorted(files)
+
+## Fingerprint everything that decides the generated documentation
+#  @param doxygen executable
+#  @param files list of relative file paths doxygen reads
+#  @return hexadecimal digest
+def getFingerprint(doxygen, files):
+  digest = hashlib.sha256(Template.probe([doxygen, "--version"]).encode())
+  for path in files:
+    info = os.stat(path)
+    digest.update("{}\0{}\0{}\0".format(path, info.st_mtime_ns,
+                                         info.st_size).encode())
+  return digest.hexdigest()
+
+## Check if a fingerprint matches the one saved
+#  @param path to saved fingerprint
+#  @param fingerprint to compare
+#  @return true if the saved fingerprint matches, false otherwise
+def isFingerprintSaved(path, fingerprint):
+  if not os.path.isfile(path):
+    return False
+  with open(path, "r") as file:
+    return file.read() == fingerprint
+
+## Remove the generated output of doxygen
+#  @param output folder of generated documentation
+#  @param keep list of names in output to not remove
+def removeOutput(output, keep=None):
+  if not os.path.exists(output):
+    return
+  if not keep:
+    shutil.rmtree(output, onerror=Template.chmodWrite)
+    return
+  for name in os.listdir(output):
+    if name in keep:
+      continue
+    path = os.path.join(output, name)
+    if os.path.isdir(path) and not os.path.islink(path):
+      shutil.rmtree(path, onerror=Template.chmodWrite)
+    else:
+      os.remove(path)
+
+## Generate documentation for a configuration
+#  @param doxygen executable
+#  @param configPath doxygen configuration file
+#  @param incremental will skip doxygen if its inputs are unchanged since the
+#    last run
+#  @param quiet will only print errors
+#  @param keep list of names in the output folder to not remove
+#  @param required list of other files doxygen generates, it runs if any is
+#    missing
+#  @return true if doxygen ran, false if skipped
+def generate(doxygen, configPath, incremental, quiet, keep=None,
+             required=None):
+  config = readDoxyfile(configPath)
+  output = os.path.join(getDoxyValue(config, "OUTPUT_DIRECTORY", "."),
+                        getDoxyValue(config, "HTML_OUTPUT", "html"))
+  # Saved inside the output so removing the output forces a run
+  fingerprintPath = os.path.join(output, ".UpdateDoxygen.fingerprint")
+  if incremental:
+    fingerprint = getFingerprint(doxygen, getInputFiles(config) +
+                                 getSupportFiles(config))
+    if isFingerprintSaved(fingerprintPath, fingerprint) and \
+        all(os.path.isfile(path) for path in required or []):
+      if not quiet:
+        print("Documentation unchanged:", output)
+      return False
+
+  removeOutput(output, keep)
+  Template.call([doxygen, configPath])
+  if incremental:
+    Template.overwriteIfChanged(fingerprintPath, fingerprint, True)
+  if not quiet:
+    print("Generated documentation:", output)
+  return True
+
+## Get the documentation partitions of targets, one per target and one for
+#  everything else
+#  @param targets list of target names
+#  @param output folder of generated documentation
+#  @return list of dictionaries {"name", "input": list of folders,
+#    "exclude": list of folders, "output": folder of generated documentation}
+def getPartitions(targets, output):
+  partitions = []
+  folders = []
+  for target in targets:
+    inputs = [path for path in ["project-" + target,
+                                os.path.join("include", target)]
+              if os.path.isdir(path)]
+    if not inputs:
+      continue
+    folders.extend(inputs)
+    partitions.append({"name": target, "input": inputs, "exclude": [],
+                       "output": os.path.join(output, target)})
+  # The remainder keeps the main page and links to each target
+  partitions.insert(0, {"name": "_main", "input": [], "exclude": folders,
+                        "output": output})
+  return partitions
+
+## Get the partitions each partition links to: those holding a file one of its
+#  files includes
+#  @param partitions list of dictionaries from getPartitions
+#  @return dictionary {partition name: set of partition names}
+def getPartitionDependencies(partitions):
+  ## Get the partition holding a path, the first is the remainder
+  #  @param path relative path
+  #  @return partition dictionary
+  def getOwner(path):
+    for partition in partitions[1:]:
+      for folder in partition["input"]:
+        if path == folder or path.startswith(os.path.join(folder, "")):
+          return partition
+    return partitions[0]
+
+  pattern = re.compile(
+      r"^[ \t]*#[ \t]*include[ \t]*[<\"]([^>\"\n]+)[>\"]", re.M)
+  dependencies = {partition["name"]: set() for partition in partitions}
+  for partition in partitions[1:]:
+    for folder in partition["input"]:
+      for root, _, filenames in os.walk(folder):
+        for filename in filenames:
+          path = os.path.join(root, filename)
+          with open(path, "r", errors="replace") as file:
+            includes = pattern.findall(file.read())
+          for include in includes:
+            # The folder of the file, the root, and include are searched
+            for directory in [root, ".", "include"]:
+              included = os.path.normpath(os.path.join(directory, include))
+              if os.path.isfile(included):
+                dependencies[partition["name"]].add(getOwner(included)["name"])
+                break
+  for name, names in dependencies.items():
+    names.discard(name)
+  return dependencies
+
+## Render the doxygen configuration of a partition
+#  @param partition dictionary from getPartitions
+#  @param htmlOutput HTML_OUTPUT of the partition
+#  @param tagFile to generate alongside the documentation
+#  @param tagFiles list of tag files to link to
+#  @return configuration file content
+def getPartitionConfig(partition, htmlOutput, tagFile, tagFiles):
+  lines = ["@INCLUDE = docs/doxyfile"]
+  if partition["input"]:
+    lines.append("INPUT = " + " ".join(partition["input"]))
+    lines.append("USE_MDFILE_AS_MAINPAGE =")
+  if partition["exclude"]:
+    lines.append("EXCLUDE += " + " ".join(partition["exclude"]))
+  lines.append("HTML_OUTPUT = " + htmlOutput)
+  lines.append("GENERATE_TAGFILE = " + tagFile)
+  lines.append("TAGFILES = " + " ".join(tagFiles))
+  return "\n".join(lines) + "\n"
+
+## Generate the documentation and tag file of a partition in one doxygen run,
+#  the tag file is only replaced if its content changed so documentation
+#  linking to it is not regenerated
+#  @param doxygen executable
+#  @param configPath doxygen configuration file, generates tagPath + ".tmp"
+#  @param tagPath to save tag file to
+#  @param incremental will skip doxygen if its inputs are unchanged since the
+#    last run
+#  @param quiet will only print errors
+#  @param keep list of names in the output folder to not remove
+#  @return true if doxygen ran, false if skipped
+def generatePartition(doxygen, configPath, tagPath, incremental, quiet, keep):
+  if not generate(doxygen, configPath, incremental, quiet, keep, [tagPath]):
+    return False
+  with open(tagPath + ".tmp", "rb") as file:
+    Template.overwriteIfChanged(tagPath, file.read(), True)
+  os.remove(tagPath + ".tmp")
+  return True
+
+## Run functions concurrently, raising the first exception after all finish
+#  @param jobs number of functions to run at once
+#  @param calls list of (function, arguments)
+#  @return list of results of the functions
+def runConcurrently(jobs, calls):
+  with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+    futures = [executor.submit(func, *funcArgs) for func, funcArgs in calls]
+    concurrent.futures.wait(futures)
+  return [future.result() for future in futures]
+
+## Generate documentation of each target separately and concurrently, linked
+#  to the partitions it includes files of with tag files. Each doxygen run
+#  writes its partition's documentation and tag file, partitions run once the
+#  tag files they link to are written.
+#  @param doxygen executable
+#  @param targets list of target names
+#  @param tagDirectory folder to save generated configurations and tag files to
+#  @param jobs number of doxygen instances to run in parallel
+#  @param incremental will skip partitions whose inputs are unchanged
+#  @param quiet will only print errors
+def generatePartitions(doxygen, targets, tagDirectory, jobs, incremental,
+                       quiet):
+  base = readDoxyfile("docs/doxyfile")
+  outputDirectory = getDoxyValue(base, "OUTPUT_DIRECTORY", ".")
+  htmlOutput = getDoxyValue(base, "HTML_OUTPUT", "html")
+  partitions = getPartitions(targets, os.path.join(outputDirectory, htmlOutput))
+  dependencies = getPartitionDependencies(partitions)
+  os.makedirs(tagDirectory, exist_ok=True)
+  for partition in partitions:
+    partition["tag"] = os.path.join(tagDirectory, partition["name"] + ".tag")
+
+  # Each wave runs the partitions whose dependencies are written. Partitions
+  # depending on each other run together, not linked to those still running.
+  done = set()
+  remaining = list(partitions)
+  while remaining:
+    wave = [partition for partition in remaining
+            if dependencies[partition["name"]] <= done] or remaining
+    calls = []
+    for partition in wave:
+      tagFiles = []
+      for other in partitions:
+        if other["name"] in dependencies[partition["name"]] & done:
+          location = os.path.relpath(other["output"], partition["output"])
+          tagFiles.append("{}={}".format(other["tag"],
+                                         location.replace(os.sep, "/")))
+      # Configurations are saved, unchanged ones keep their modification time
+      configPath = os.path.join(tagDirectory, partition["name"] + ".doxyfile")
+      Template.overwriteIfChanged(configPath, getPartitionConfig(
+          partition, os.path.relpath(partition["output"], outputDirectory),
+          partition["tag"] + ".tmp", tagFiles), True)
+      keep = [os.path.basename(other["output"]) for other in partitions
+              if os.path.dirname(other["output"]) == partition["output"]]
+      calls.append((generatePartition, (doxygen, configPath, partition["tag"],
+                                        incremental, quiet, keep)))
+    runConcurrently(jobs, calls)
+    done.update(partition["name"] for partition in wave)
+    remaining = [partition for partition in remaining if partition not in wave]
+
 ## Main function
 def main():
   # Create an arg parser menu and grab the values from the command arguments
@@ -51,6 +372,26 @@ def main():
                       help="name of project to add to generated documentation")
   parser.add_argument("--project-brief", required=True,
                       help="brief of project to add to generated documentation")
+  parser.add_argument("--incremental", action="store_true", default=False,
+                      help="skip doxygen if its inputs are unchanged since the "
+                      "last run")
+  parser.add_argument("--targets", metavar="NAME", nargs="+", default=[],
+                      help="document each target's project-NAME and "
+                      "include/NAME folders separately and concurrently, "
+                      "linked to each other with tag files")
+  parser.add_argument("--tag-directory", metavar="PATH",
+                      default="build/doxygen-tags",
+                      help="folder to save generated configurations and tag "
+                      "files of --targets to")
+  parser.add_argument("-j", type=int, default=multiprocessing.cpu_count(),
+                      help="number of doxygen instances to be run in parallel")
+  parser.add_argument("--version-json", metavar="PATH", default=None,
+                      help="version manifest written by "
+                      "CreateVersionFromGitTag.py --output-json to read "
+                      "instead of querying git, untracked files are scanned "
+                      "for if it was written with --no-untracked")
+  parser.add_argument("--refresh-probes", action="store_true", default=False,
+                      help="probe each binary even if a previous result is cached")
 
   argv = sys.argv[1:]
   args = parser.parse_args(argv)
@@ -58,10 +399,17 @@ def main():
   Template.checkInstallations(
       git=args.git,
       doxygen=args.doxygen,
-      quiet=args.quiet)
+      quiet=args.quiet,
+      refresh=args.refresh_probes)
 
   try:
-    version = VersionTag.getVersion(args.git)
+    if args.version_json:
+      version, untracked = VersionTag.readManifest(args.version_json)
+      if not version.modified and not untracked:
+        version.modified = VersionTag.hasUntrackedFiles(args.git)
+    else:
+      # Reads the git directory, sharing one git cat-file for packed objects
+      version = VersionTag.getVersion(args.git, direct=True)
   except Exception:
     print("Exception getting version from git tags", file=sys.stderr)
     traceback.print_exc()
@@ -82,11 +430,12 @@ PROJECT_BRIEF          = "{args.project_brief}"
 """
   Template.overwriteIfChanged(args.doxygen_output, data, args.quiet)
 
-  if os.path.exists("docs/www/doxygen"):
-    shutil.rmtree("docs/www/doxygen", onerror=Template.chmodWrite)
   try:
-    cmd = [args.doxygen, "docs/doxyfile"]
-    Template.call(cmd)
+    if args.targets:
+      generatePartitions(args.doxygen, args.targets, args.tag_directory,
+                         args.j, args.incremental, args.quiet)
+    else:
+      generate(args.doxygen, "docs/doxyfile", args.incremental, args.quiet)
   except Exception:
     print("Exception running doxygen", file=sys.stderr)
     traceback.print_exc()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+## A script to validate the version read from the git directory against git
+#  describe. Builds throwaway repositories with the local git binary covering
+#  the layouts GitReader.py handles or must fall back on.
+
+import CreateVersionFromGitTag as VersionTag
+import Template
+
+import argparse
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+## Class to build a throwaway repository and compare versions in it
+class Scenario:
+  ## Initialize a repository
+  #  @param self object pointer
+  #  @param git executable
+  #  @param directory to create the repository in
+  def __init__(self, git, directory):
+    self.git = git
+    self.directory = directory
+    self.env = dict(os.environ, GIT_AUTHOR_NAME="Validate",
+                    GIT_AUTHOR_EMAIL="validate@localhost",
+                    GIT_COMMITTER_NAME="Validate",
+                    GIT_COMMITTER_EMAIL="validate@localhost",
+                    GIT_CONFIG_NOSYSTEM="1", HOME=directory)
+    os.makedirs(directory)
+    self.run("init", "-q")
+    self.commits = 0
+    self.start = int(time.time())
+    self.settled = 0
+
+  ## Run git in the repository
+  #  @param self object pointer
+  #  @param args arguments to git
+  #  @return stdout of git
+  def run(self, *args):
+    return subprocess.check_output([self.git] + list(args), cwd=self.directory,
+                                   env=self.env, universal_newlines=True,
+                                   stderr=subprocess.DEVNULL)
+
+  ## Write a file in the worktree
+  #  @param self object pointer
+  #  @param name of file relative to the worktree
+  #  @param content to write
+  def write(self, name, content):
+    with open(os.path.join(self.directory, name), "w") as file:
+      file.write(content)
+
+  ## Commit a change to a file
+  #  @param self object pointer
+  #  @param name of file to change
+  #  @param date of the commit in seconds since the epoch, default is a minute
+  #    after the previous one
+  def commit(self, name="file", date=None):
+    self.commits += 1
+    if date is None:
+      date = 1600000000 + 60 * self.commits
+    self.write(name, "commit {}\n".format(self.commits))
+    self.run("add", name)
+    self.env["GIT_AUTHOR_DATE"] = "{} +0000".format(date)
+    self.env["GIT_COMMITTER_DATE"] = "{} +0000".format(date)
+    self.run("commit", "-q", "-m", "Commit {}".format(self.commits))
+
+  ## Move the stamps of the worktree into the past and refresh the index, so
+  #  no entry is racily clean. git may only compare whole seconds, each call
+  #  uses a different second.
+  #  @param self object pointer
+  #  @param directory of the worktree, default is the repository
+  def settle(self, directory=None):
+    directory = directory or self.directory
+    self.settled += 1
+    past = self.start - 1000 + self.settled
+    for root, dirs, files in os.walk(directory):
+      dirs[:] = [d for d in dirs if d != ".git"]
+      for name in files:
+        os.utime(os.path.join(root, name), (past, past))
+    subprocess.call([self.git, "update-index", "-q", "--refresh"],
+                    cwd=directory, env=self.env,
+                    stdout=subprocess.DEVNULL)
+
+  ## Compare the version read directly with git describe
+  #  @param self object pointer
+  #  @param name of the case
+  #  @param directory to compare in, default is the repository
+  #  @return true if the versions match or the reader fell back to git
+  def compare(self, name, directory=None):
+    directory = directory or self.directory
+    description = subprocess.check_output(
+        [self.git, "describe", "--tags", "--long", "--dirty"], cwd=directory,
+        env=self.env, universal_newlines=True).strip()
+    matches = re.match(r"^(.*)-(\d+)-g([0-9a-f]+)(-dirty)?$", description)
+    expected = (matches[1], int(matches[2]), matches[4] is not None,
+                matches[3])
+
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+      version = VersionTag.getVersionDirect(self.git)
+    finally:
+      os.chdir(cwd)
+      Template.closeGitObjects()
+    if version is None:
+      print("OK       {:<24} {} (falls back to git)".format(name, description))
+      return True
+    result = (version.string, version.ahead, version.modified, version.gitSHA)
+    if result != expected:
+      print("MISMATCH {:<24} git {}, read {}".format(name, expected, result),
+            file=sys.stderr)
+      return False
+    print("OK       {:<24} {}".format(name, description))
+    return True
+
+## Validate the common layouts of a repository
+#  @param git executable
+#  @param tmpdir directory to create repositories in
+#  @return true if every case matches
+def validateLayouts(git, tmpdir):
+  repo = Scenario(git, os.path.join(tmpdir, "layouts"))
+  status = True
+  repo.commit()
+  repo.run("tag", "0.1.0")
+  repo.commit()
+  repo.commit("other")
+  repo.settle()
+  status &= repo.compare("lightweight tag")
+
+  repo.run("tag", "-a", "1.0.0", "-m", "Release", "HEAD~1")
+  status &= repo.compare("annotated tag")
+
+  repo.run("checkout", "-q", "-b", "side", "HEAD~2")
+  repo.commit("side")
+  repo.run("tag", "1.1.0-rc")
+  repo.run("checkout", "-q", "-")
+  repo.run("merge", "-q", "--no-edit", "side")
+  repo.settle()
+  status &= repo.compare("merge")
+
+  repo.run("pack-refs", "--all")
+  status &= repo.compare("packed refs")
+
+  repo.run("checkout", "-q", "HEAD~1")
+  repo.settle()
+  status &= repo.compare("detached HEAD")
+  repo.run("checkout", "-q", "-")
+  repo.settle()
+
+  os.remove(os.path.join(repo.directory, "other"))
+  status &= repo.compare("deleted file")
+  repo.run("checkout", "-q", "other")
+  repo.settle()
+
+  repo.write("other", "staged\n")
+  repo.run("add", "other")
+  repo.settle()
+  status &= repo.compare("staged change")
+
+  repo.write("file", "unstaged change\n")
+  status &= repo.compare("unstaged change")
+  repo.run("checkout", "-q", ".")
+  repo.run("reset", "-q", "--hard")
+  repo.settle()
+
+  if os.name != "nt":
+    os.chmod(os.path.join(repo.directory, "file"), 0o755)
+    status &= repo.compare("mode change")
+    os.chmod(os.path.join(repo.directory, "file"), 0o644)
+    repo.settle()
+
+  worktree = os.path.join(tmpdir, "worktree")
+  repo.run("worktree", "add", "-q", worktree, "HEAD~1")
+  repo.settle(worktree)
+  status &= repo.compare("linked worktree", worktree)
+  repo.run("worktree", "remove", "--force", worktree)
+
+  repo.run("gc", "-q")
+  status &= repo.compare("packed objects")
+
+  repo.run("update-index", "--split-index")
+  repo.settle()
+  os.remove(os.path.join(repo.directory, "other"))
+  status &= repo.compare("split index")
+  return status
+
+## Validate a repository with a random history of branches, merges and tags
+#  @param git executable
+#  @param tmpdir directory to create the repository in
+#  @param seed of the random history
+#  @return true if the versions match
+def validateRandom(git, tmpdir, seed):
+  generator = random.Random(seed)
+  repo = Scenario(git, os.path.join(tmpdir, "random-{}".format(seed)))
+  repo.commit()
+  repo.run("tag", "0.0.1")
+  main = repo.run("rev-parse", "--abbrev-ref", "HEAD").strip()
+  for i in range(60):
+    roll = generator.randrange(10)
+    if roll < 2:
+      base = "{}~{}".format(main, generator.randrange(4))
+      if subprocess.call([git, "rev-parse", "-q", "--verify", base],
+                         cwd=repo.directory, stdout=subprocess.DEVNULL) == 0:
+        repo.run("checkout", "-q", "-B",
+                 "branch{}".format(generator.randrange(3)), base)
+    elif roll == 2:
+      repo.run("checkout", "-q", main)
+      branch = "branch{}".format(generator.randrange(3))
+      if subprocess.call([git, "rev-parse", "-q", "--verify", branch],
+                         cwd=repo.directory, stdout=subprocess.DEVNULL) == 0:
+        repo.run("merge", "-q", "--no-edit", "-X", "theirs", branch)
+    # Dates are not ordered between branches, some are equal
+    repo.commit("file{}".format(generator.randrange(5)),
+                1600000000 + i * generator.randrange(3))
+    if generator.randrange(7) == 0:
+      repo.run("tag", "1.{}.0".format(i))
+    if generator.randrange(9) == 0:
+      repo.run("tag", "-a", "2.{}.0".format(i), "-m", "Release")
+  repo.run("checkout", "-q", main)
+  if generator.randrange(2):
+    repo.run("gc", "-q")
+  repo.settle()
+  return repo.compare("random seed {}".format(seed))
+
+## Main function
+def main():
+  # Create an arg parser menu and grab the values from the command arguments
+  parser = argparse.ArgumentParser(description="Validate the version read "
+                                   "from the git directory against git "
+                                   "describe in throwaway repositories")
+  parser.add_argument("--git", metavar="PATH", default="git",
+                      help="path to git binary")
+  parser.add_argument("--random", metavar="N", type=int, default=10,
+                      help="number of repositories with a random history to "
+                      "validate")
+  parser.add_argument("--seed", metavar="N", type=int, default=0,
+                      help="seed of the first random history")
+
+  argv = sys.argv[1:]
+  args = parser.parse_args(argv)
+
+  Template.checkInstallations(git=args.git)
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    status = validateLayouts(args.git, tmpdir)
+    for seed in range(args.seed, args.seed + args.random):
+      status &= validateRandom(args.git, tmpdir, seed)
+
+  if not status:
+    print("Version read from the git directory differs from git describe",
+          file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+## A script to validate the headers Clang-TidyFormat.py plans clang-tidy to
+#  report diagnostics in. Each translation unit of the compilation database is
+#  preprocessed with its own compile command, the compiler listing the paths
+#  it opened headers with (-H), which clang-tidy matches HeaderFilterRegex
+#  against.
+
+import CompileDatabase
+import Template
+
+import argparse
+import importlib.util
+import os
+import re
+import shlex
+import subprocess
+import sys
+
+## Load Clang-TidyFormat.py as a module
+#  @return module object
+def loadTidyFormat():
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "Clang-TidyFormat.py")
+  spec = importlib.util.spec_from_file_location("TidyFormat", path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+## Get the paths the compiler opens headers with for a translation unit
+#  @param entry of the compilation database
+#  @return list of paths as the compiler printed them, None if it failed
+def getCompilerOpenedPaths(entry):
+  if "arguments" in entry:
+    arguments = list(entry["arguments"])
+  else:
+    arguments = shlex.split(entry["command"], posix=(os.name != "nt"))
+  # Only preprocess, dropping the outputs of the command
+  cmd = []
+  i = 0
+  while i < len(arguments):
+    if arguments[i] in ("-o", "-MF", "-MT", "-MQ"):
+      i += 2
+      continue
+    if arguments[i] not in ("-c", "-MD", "-MMD"):
+      cmd.append(arguments[i])
+    i += 1
+  cmd += ["-E", "-H", "-o", os.devnull]
+  try:
+    proc = subprocess.run(cmd, cwd=entry["directory"], stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+  except OSError:
+    return None
+  if proc.returncode != 0:
+    return None
+  return [matches[1] for matches in re.finditer(r"^\.+ (.+)$", proc.stderr,
+                                                re.M)]
+
+## Validate the headers reported by each translation unit against the paths
+#  the compiler opened them with
+#  @param tidyFormat Clang-TidyFormat module
+#  @param compileCommands CompileDatabase to look up compile commands in
+#  @param root directory of the repository
+#  @param name of the regex validated
+#  @return true if every translation unit matches
+def validateHeaders(tidyFormat, compileCommands, root, name):
+  scanner = tidyFormat.IncludeScanner(root)
+  status = True
+  for file, entry in sorted(compileCommands.items()):
+    relative = os.path.relpath(file, root)
+    opened = getCompilerOpenedPaths(entry)
+    if opened is None:
+      print("SKIP     {:<16} {} failed to preprocess".format(name, relative))
+      continue
+    regex = tidyFormat.getHeaderFilterRegex(os.path.dirname(file))
+    expected = set()
+    included = set()
+    for path in opened:
+      absolute = os.path.normpath(os.path.join(entry["directory"], path))
+      if not absolute.startswith(scanner.root):
+        continue
+      included.add(absolute)
+      if regex and regex.search(path):
+        expected.add(absolute)
+
+    # The scanner does not evaluate #if, only compare the headers the compiler
+    # included
+    reported = tidyFormat.getReportedHeaders([file], compileCommands,
+                                             scanner)[file] & included
+    if reported != expected:
+      print("MISMATCH {:<16} {} clang-tidy {}, planned {}".format(
+          name, relative, sorted(expected), sorted(reported)), file=sys.stderr)
+      status = False
+      continue
+    print("OK       {:<16} {} reports {} of {} headers".format(
+        name, relative, len(expected), len(included)))
+  return status
+
+## Main function
+def main():
+  # Create an arg parser menu and grab the values from the command arguments
+  root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  parser = argparse.ArgumentParser(description="Validate the headers "
+                                   "clang-tidy reports diagnostics in against "
+                                   "the paths the compiler opens them with")
+  parser.add_argument("-p", metavar="PATH",
+                      default=os.path.join(root, "build"),
+                      help="Path used to read a compile command database.")
+  parser.add_argument("--header-filter", metavar="REGEX", action="append",
+                      default=[], help="additional HeaderFilterRegex to "
+                      "validate in place of the .clang-tidy configuration's")
+
+  argv = sys.argv[1:]
+  args = parser.parse_args(argv)
+
+  if os.path.isdir(args.p):
+    args.p = os.path.join(args.p, "compile_commands.json")
+  if not os.path.isfile(args.p):
+    print("Could not find compile_commands.json, configure the project with "
+          "CMake first", file=sys.stderr)
+    sys.exit(1)
+
+  tidyFormat = loadTidyFormat()
+  compileCommands = CompileDatabase.CompileDatabase(args.p).open()
+  status = validateHeaders(tidyFormat, compileCommands, root, ".clang-tidy")
+  for headerFilter in args.header_filter:
+    regex = re.compile(headerFilter)
+    tidyFormat.getHeaderFilterRegex = lambda directory: regex
+    status &= validateHeaders(tidyFormat, compileCommands, root, headerFilter)
+
+  if not status:
+    print("Headers planned differ from the headers clang-tidy reports",
+          file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()